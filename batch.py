@@ -0,0 +1,267 @@
+# batch.py
+# rank many courses at once with student ranking program (rank.py)
+# python3
+
+"""
+Rank every course of a term in one run, with a pool of worker
+processes (so interpreter startup and imports are paid once per
+worker, not once per course):
+
+    python3 batch.py term_dir/ --jobs 8
+    python3 batch.py manifest.json --jobs 8
+
+Given a directory, every CSV file in it (other than .rank.csv,
+.sweep.csv and .stability.csv outputs) and every gradebook file (see
+gradebook.py) is a course; a CSV file and its gradebook are one course.
+Given a JSON manifest, it lists the courses, each either a file name
+or an object with an "input" file name and optional overrides:
+
+    [ "6.006.csv",
+      {"input": "6.046.csv", "rank_weight": 1.0,
+       "drop_policy": [[1, "Q1", "Q2"]], "skiprows": 2} ]
+
+Relative file names are relative to the manifest's directory.
+Courses without overrides follow policy.py.
+
+For each course the usual three .rank.csv files are written (next to
+the input, or in --output-dir), just as by rank.py, but without the
+terminal listings.  A course that fails is reported, and the others
+are still ranked.  A summary of all courses (students, status, time
+for each step) is printed and written as JSON to --report.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import types
+
+import policy
+import rank
+
+OUTPUT_SUFFIXES = [".1.grades.rank.csv",
+                   ".2.scores.rank.csv",
+                   ".3.droppedscores.rank.csv"]
+
+# CSV files in a course directory that are outputs, not courses
+OUTPUT_CSV_SUFFIXES = (".rank.csv", ".sweep.csv", ".stability.csv")
+
+def find_courses(path):
+    """
+    Return list of courses (dicts with "input" and any overrides) in
+    given directory or JSON manifest.  A manifest entry that isn't a
+    file name or an object with an "input" file name is returned as a
+    course with an "error", which rank_course reports as failed.
+    """
+    if os.path.isdir(path):
+        return find_directory_courses(path)
+    with open(path) as file:
+        manifest = json.load(file)
+    base_dir = os.path.dirname(path)
+    courses = []
+    for i, entry in enumerate(manifest):
+        if not isinstance(entry, dict):
+            entry = {"input": entry}
+        course = dict(entry)
+        if not isinstance(entry.get("input"), str):
+            course["input"] = "manifest entry %d" % i
+            course["error"] = "bad manifest entry (no \"input\" file name): %s" \
+                % json.dumps(entry)
+        else:
+            course["input"] = os.path.join(base_dir, entry["input"])
+        courses.append(course)
+    return courses
+
+def find_directory_courses(path):
+    """
+    Return list of courses in given directory: its CSV files, other than
+    outputs of rank.py, sweep.py and stability.py, and its gradebook
+    files.  A CSV file x.csv and its gradebook x.csv.gradebook are one
+    course, read from the gradebook unless the CSV file is newer (or
+    gradebooks can't be read, without numpy).
+    """
+    names = set(os.listdir(path))
+    courses = []
+    for name in sorted(names):
+        if name.endswith(".gradebook"):
+            csv_name = name[:-len(".gradebook")]
+            if csv_name in names and not use_gradebook(path, csv_name, name):
+                continue
+        elif name.endswith(".csv") and not name.endswith(OUTPUT_CSV_SUFFIXES):
+            if name + ".gradebook" in names \
+               and use_gradebook(path, name, name + ".gradebook"):
+                continue
+        else:
+            continue
+        courses.append({"input": os.path.join(path, name)})
+    return courses
+
+def use_gradebook(path, csv_name, gradebook_name):
+    """
+    Return True if a course in directory path with both a CSV file and
+    a gradebook file should be read from the gradebook.
+    """
+    if rank.gradebook is None:
+        return False
+    return os.path.getmtime(os.path.join(path, gradebook_name)) \
+        >= os.path.getmtime(os.path.join(path, csv_name))
+
+def course_policy(course):
+    """
+    Return policy for course: policy.py, with any RANK_WEIGHT or
+    DROP_POLICY overrides given for the course.
+    """
+    drop_policy = policy.DROP_POLICY
+    if "drop_policy" in course:
+        drop_policy = [tuple(item) for item in course["drop_policy"]]
+    return types.SimpleNamespace(
+        RANK_WEIGHT=course.get("rank_weight", policy.RANK_WEIGHT),
+        DROP_POLICY=drop_policy,
+        compute_wtd_scores=policy.compute_wtd_scores,
+        drop=policy.drop,
+        print_drop_policy=policy.print_drop_policy,
+        compile_drop_policy=policy.compile_drop_policy)
+
+def rank_course(course, output_dir=None):
+    """
+    Rank one course and write its .rank.csv files.  Return summary
+    dict: input, status ("ok" or "failed"), error (if failed), number
+    of students and columns, outputs written, and seconds per step.
+    Exceptions are caught and reported in the summary, not raised.
+    """
+    summary = {"input": course["input"], "status": "ok",
+               "seconds": dict(), "outputs": []}
+    def timed(step, f, *args):
+        t0 = time.perf_counter()
+        try:
+            return f(*args)
+        finally:
+            summary["seconds"][step] = time.perf_counter() - t0
+
+    if "error" in course:
+        summary["status"] = "failed"
+        summary["error"] = course["error"]
+        summary["total_seconds"] = 0.0
+        return summary
+    output_base = course["input"]
+    if output_dir is not None:
+        output_base = os.path.join(output_dir, os.path.basename(output_base))
+    try:
+        grade_state = timed("read", read_course, course)
+        summary["n_stu"] = grade_state.n_stu
+        summary["n_col"] = grade_state.n_col
+        result = timed("rank", rank.rank_pipeline, grade_state,
+                       course_policy(course))
+        states = [result.grade_state, result.score_state,
+                  result.dropped_state]
+        def write_outputs():
+            for suffix, state in zip(OUTPUT_SUFFIXES, states):
+                if state is not None:
+                    with open(output_base + suffix, "w",
+                              buffering=1<<16) as file:
+                        rank.write_output(state, file)
+                    summary["outputs"].append(output_base + suffix)
+        timed("write", write_outputs)
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = "%s: %s" % (type(e).__name__, e)
+    summary["total_seconds"] = sum(summary["seconds"].values())
+    return summary
+
+def read_course(course):
+    """ Return converted grade state of course (CSV or gradebook file). """
+    if rank.gradebook is not None \
+       and rank.gradebook.is_gradebook(course["input"]):
+        return rank.gradebook.load_state(course["input"])
+    return rank.read_grades(course["input"], int(course.get("skiprows", 0)))
+
+def run_batch(courses, jobs=1, output_dir=None, progress=None):
+    """
+    Rank all courses, with at most 'jobs' worker processes (or in this
+    process, if jobs is 1).  Return list of summaries (see rank_course),
+    in the order of courses.  If progress is given, progress(summary) is
+    called as each course finishes.
+    """
+    summaries = [None for course in courses]
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) \
+             as executor:
+            futures = {executor.submit(rank_course, course, output_dir): i
+                       for i, course in enumerate(courses)}
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    summaries[i] = future.result()
+                except Exception as e:
+                    # e.g. the worker process died
+                    summaries[i] = {"input": courses[i]["input"],
+                                    "status": "failed",
+                                    "error": "%s: %s" % (type(e).__name__, e),
+                                    "seconds": dict(), "outputs": [],
+                                    "total_seconds": 0.0}
+                if progress is not None:
+                    progress(summaries[i])
+    else:
+        for i, course in enumerate(courses):
+            summaries[i] = rank_course(course, output_dir)
+            if progress is not None:
+                progress(summaries[i])
+    return summaries
+
+def print_progress(summary):
+    """ Print one line for a finished course. """
+    if summary["status"] == "ok":
+        print("  ok      %7.3fs %8d students  %s"
+              % (summary["total_seconds"], summary["n_stu"], summary["input"]))
+    else:
+        print("  FAILED  %7.3fs %17s %s\n          %s"
+              % (summary["total_seconds"], "", summary["input"],
+                 summary["error"]))
+
+def main():
+    """ Main routine. """
+    parser = argparse.ArgumentParser(\
+                description='Rank students in many courses at once.')
+    parser.add_argument('courses',
+                        help='directory of course CSV (or gradebook) files, '\
+                        'or JSON manifest of courses')
+    parser.add_argument('--jobs', default=os.cpu_count() or 1,
+                        help='number of worker processes')
+    parser.add_argument('--output-dir',
+                        help='directory for .rank.csv files '\
+                        '(default: next to each input file)')
+    parser.add_argument('--report', default='batch_report.json',
+                        help='JSON file for summary of all courses')
+    args = parser.parse_args()
+
+    courses = find_courses(args.courses)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    print("Ranking %d courses (%d jobs)" % (len(courses), int(args.jobs)))
+    t0 = time.perf_counter()
+    summaries = run_batch(courses, int(args.jobs), args.output_dir,
+                          print_progress)
+    wall_seconds = time.perf_counter() - t0
+
+    failed = [s for s in summaries if s["status"] != "ok"]
+    report = {"courses": summaries,
+              "n_courses": len(summaries),
+              "n_failed": len(failed),
+              "n_students": sum(s.get("n_stu", 0) for s in summaries
+                                if s["status"] == "ok"),
+              "wall_seconds": wall_seconds,
+              "course_seconds": sum(s["total_seconds"] for s in summaries)}
+    with open(args.report, "w") as file:
+        json.dump(report, file, indent=1)
+        file.write("\n")
+    print("%d courses (%d failed), %d students, %.3fs"
+          % (report["n_courses"], report["n_failed"],
+             report["n_students"], wall_seconds))
+    print(args.report, "written.")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
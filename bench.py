@@ -0,0 +1,411 @@
+# bench.py
+# benchmark harness for student ranking program (rank.py)
+# python3
+
+"""
+Time each stage of the rank.py pipeline on data sets generated by
+make_data.py, and check correctness against the golden *.rank.csv
+outputs in the repository (and incremental.py against full reruns).
+
+    python3 bench.py                          # default sizes
+    python3 bench.py --sizes 1000x7,100000x50 # students x components
+    python3 bench.py --save-baseline          # store results as baseline
+
+Each size "NxC" means N students and C graded components (C-3
+homeworks, two quizzes and a final, as produced by make_data.py).
+Generated data sets are cached in bench_data/.  Each data set is
+timed in a fresh process, so that its peak RSS can be measured.
+
+Every run is appended to a JSON history file (bench_history.json),
+and compared against a stored baseline (bench_baseline.json); any
+stage slower than the baseline by more than the given tolerance is
+flagged as a regression (and the exit status is then 1).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import types
+
+import incremental
+import make_data
+import policy
+import rank
+import sketch
+
+DEFAULT_SIZES = "10x7,100x7,1000x7,10000x7,1000x50,10000x100"
+
+STAGES = ["read_csv", "parse_csv", "convert_data", "compute_scores",
+          "policy.drop", "compute_wtd_scores", "rank_by", "write_output"]
+
+def parse_size(size):
+    """ Return (n_students, n_components) for size string "NxC". """
+    n_stu, n_comp = size.lower().split("x")
+    n_stu, n_comp = int(n_stu), int(n_comp)
+    if n_comp < 4:
+        raise ValueError("need at least 4 components (one homework, "
+                         "two quizzes and a final): " + size)
+    return n_stu, n_comp
+
+def data_file(data_dir, size, seed):
+    """
+    Return filename of data set of given size, first generating it
+    with make_data.py if it isn't already there.
+    """
+    n_stu, n_comp = parse_size(size)
+    file_name = os.path.join(data_dir, "bench_%dx%d_seed%d.csv"
+                             % (n_stu, n_comp, seed))
+    if not os.path.exists(file_name):
+        os.makedirs(data_dir, exist_ok=True)
+        rows = make_data.make_rows(n_stu, n_comp-3, seed)
+        with open(file_name + ".tmp", "w") as file:
+            make_data.write_rows(rows, file)
+        os.replace(file_name + ".tmp", file_name)
+    return file_name
+
+def time_stages(input_filename):
+    """
+    Run the rank.py pipeline on input_filename, timing each stage.
+    Return dict with the number of students and columns, the time
+    in seconds for each stage, and the peak RSS of this process (KB).
+    """
+    seconds = dict()
+    def timed(stage, f, *args):
+        t0 = time.perf_counter()
+        value = f(*args)
+        seconds[stage] = time.perf_counter() - t0
+        return value
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = timed("read_csv", rank.read_csv, input_filename)
+        state = timed("parse_csv", rank.parse_csv, rows)
+        del rows
+        grade_state = timed("convert_data", rank.convert_data, state)
+        score_state = timed("compute_scores", rank.compute_scores, grade_state)
+        dropped_state = timed("policy.drop", policy.drop, score_state.copy(),
+                              policy.DROP_POLICY, False)
+        wtd_score = timed("compute_wtd_scores", policy.compute_wtd_scores,
+                          dropped_state)
+        sorted_state = timed("rank_by", rank.rank_by,
+                             dropped_state, wtd_score)
+        with open(os.devnull, "w") as file:
+            timed("write_output", rank.write_output, sorted_state, file)
+
+    return {"n_stu": state.n_stu,
+            "n_col": state.n_col,
+            "seconds": seconds,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def run_one(input_filename, repeat):
+    """
+    Time pipeline on input_filename in 'repeat' fresh processes.
+    Return best time for each stage, and largest peak RSS.
+    """
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, __file__, "--one",
+                                 input_filename],
+                                stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True).stdout
+        result = json.loads(output)
+        if best is None:
+            best = result
+        else:
+            for stage in STAGES:
+                best["seconds"][stage] = min(best["seconds"][stage],
+                                             result["seconds"][stage])
+            best["peak_rss_kb"] = max(best["peak_rss_kb"],
+                                      result["peak_rss_kb"])
+    best["total_seconds"] = sum(best["seconds"].values())
+    best["rows_per_second"] = {stage: best["n_stu"] / max(t, 1e-9)
+                               for stage, t in best["seconds"].items()}
+    return best
+
+##############################################################################
+## Correctness checks against golden outputs
+##############################################################################
+
+def cells(text):
+    """ Return output text as list of rows of stripped cells. """
+    return [[cell.strip() for cell in line.split(",")]
+            for line in text.splitlines()]
+
+def check_golden(input_filename, rows, rank_weight, sketch_k=None):
+    """
+    Rank the students in given rows (in the format read by
+    rank.parse_csv), with given RANK_WEIGHT and the policy.py drop
+    policy, and compare with the three golden .rank.csv files for
+    input_filename.  Only cell values are compared, not the spacing.
+    If sketch_k is given, scores are approximated from sketches of that
+    size (see rank.compute_scores_approx; exact for small classes).
+    Return list of names of golden files that don't match.
+    """
+    pol = types.SimpleNamespace(RANK_WEIGHT=rank_weight,
+                                DROP_POLICY=policy.DROP_POLICY,
+                                compute_wtd_scores=policy.compute_wtd_scores,
+                                drop=policy.drop)
+    grade_state = rank.convert_data(rank.parse_csv(rows))
+    sketches = None
+    if sketch_k is not None:
+        sketches = sketch.build_sketches(grade_state, sketch_k)
+    result = rank.rank_pipeline(grade_state, pol, sketches=sketches)
+    mismatches = []
+    for suffix, state in [(".1.grades.rank.csv", result.grade_state),
+                          (".2.scores.rank.csv", result.score_state),
+                          (".3.droppedscores.rank.csv", result.dropped_state)]:
+        golden_filename = input_filename + suffix
+        if not os.path.exists(golden_filename):
+            continue
+        with open(golden_filename) as file:
+            if cells(rank.build_output(state, ", ")) != cells(file.read()):
+                mismatches.append(golden_filename)
+    return mismatches
+
+def check_goldens(repo_dir):
+    """
+    Check rank.py against all golden outputs in repository.
+    test0005.csv (in the top directory) is in the current (version 0.3)
+    format.  The examples/ files are in the version 0.2 format, which
+    has no perfect_grade row, and were produced with all rank-based
+    scoring, i.e. RANK_WEIGHT = 1.0.
+    Return list of golden files that don't match.
+    """
+    checks = [(os.path.join(repo_dir, "test0005.csv"), False, policy.RANK_WEIGHT)]
+    examples_dir = os.path.join(repo_dir, "examples")
+    for name in sorted(os.listdir(examples_dir)):
+        if name.startswith("test") and name.endswith(".csv") \
+           and name.count(".") == 1:
+            checks.append((os.path.join(examples_dir, name), True, 1.0))
+
+    mismatches = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for input_filename, version_02, rank_weight in checks:
+            rows = rank.read_csv(input_filename)
+            if version_02:
+                rows = [rows[0], ["1"]*len(rows[0])] + rows[1:]
+            mismatches.extend(check_golden(input_filename, rows, rank_weight))
+    print("Checked golden outputs for %d input files:" % len(checks),
+          "%d mismatches" % len(mismatches))
+    for golden_filename in mismatches:
+        print("  ** MISMATCH:", golden_filename)
+    return mismatches
+
+def check_approx(repo_dir):
+    """
+    Check approximate scoring (rank.py --approx): with sketches big
+    enough to be exact, test0005.csv must give its golden outputs, and
+    a class with no weighted columns (so no sketches) must be handled.
+    Return number of failed checks.
+    """
+    input_filename = os.path.join(repo_dir, "test0005.csv")
+    failures = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = rank.read_csv(input_filename)
+        if check_golden(input_filename, rows, policy.RANK_WEIGHT,
+                        sketch.DEFAULT_K):
+            failures += 1
+        unweighted = [rows[0], rows[1], ["0"]*len(rows[0])] + rows[3:]
+        grade_state = rank.convert_data(rank.parse_csv(unweighted))
+        sketches = sketch.build_sketches(grade_state)
+        try:
+            sketch.print_error_report(grade_state.names, sketches)
+            if rank.compare_approx(grade_state, sketches) != (0.0, 0):
+                failures += 1
+        except Exception:
+            failures += 1
+    print("Checked approximate scores: %d failures" % failures)
+    return failures
+
+DROP_TABLES = 200               # random score tables checked by check_drop
+
+def reference_drop(state, drop_policy):
+    """
+    Return rows of state's scores after applying drop_policy row by row
+    with policy.process_drop_policy_item (the reference for policy.drop).
+    """
+    rows = []
+    for row in state.data:
+        row = list(row)
+        for drop_policy_item in drop_policy:
+            row = policy.process_drop_policy_item(state.names, row,
+                                                  drop_policy_item)
+        rows.append([policy.MISSING if d == -1 else d for d in row])
+    return rows
+
+def check_drop(n_tables=DROP_TABLES, seed=1):
+    """
+    Check policy.apply_drop_plan (with and without numpy) against
+    reference_drop on random score tables: few distinct scores (so
+    many ties), MISSING and -1 scores, and repeated column names.
+    Return number of tables where they differ.
+    """
+    rng = random.Random(seed)
+    numpy = policy.np
+    n_wrong = 0
+    for _ in range(n_tables):
+        n_col = rng.randrange(1, 8)
+        names = [rng.choice(["H1", "H2", "H3", "Q1", "Q2", "F"])
+                 for col in range(n_col)]
+        data = [[rng.choice([policy.MISSING, -1, 0.0, 0.25, 0.5, 1.0])
+                 for col in range(n_col)]
+                for stu in range(rng.randrange(0, 30))]
+        drop_policy = [tuple([rng.randrange(0, 4)]
+                             + rng.sample(["H1", "H2", "H3", "Q1", "Q2", "X"],
+                                          rng.randrange(1, 5)))
+                       for item in range(rng.randrange(0, 3))]
+        state = rank.CowState(names, [1]*n_col, [1]*n_col, data)
+        expected = reference_drop(state, drop_policy)
+        for backend in set([numpy, None]):
+            policy.np = backend
+            plan = policy.compile_drop_policy(names, drop_policy)
+            dropped = policy.apply_drop_plan(state, plan)
+            if drop_policy and [list(row) for row in dropped.data] != expected:
+                n_wrong += 1
+        policy.np = numpy
+    print("Checked drop plans on %d random score tables:" % n_tables,
+          "%d mismatches" % n_wrong)
+    return n_wrong
+
+INCREMENTAL_UPDATES = 200       # random updates checked by check_incremental
+
+def check_incremental(repo_dir, n_updates=INCREMENTAL_UPDATES, seed=1):
+    """
+    Check incremental.IncrementalRanking against full reruns of
+    rank.rank_pipeline, after each of n_updates random grade updates to
+    examples/test0100.csv (see incremental.check_random_updates).
+    Return number of updates after which they disagree.
+    """
+    input_filename = os.path.join(repo_dir, "examples", "test0100.csv")
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = rank.read_csv(input_filename)
+    rows = [rows[0], ["1"]*len(rows[0])] + rows[1:]     # version 0.2 format
+    grade_state = rank.convert_data(rank.parse_csv(rows))
+    n_wrong = incremental.check_random_updates(grade_state, n_updates, seed)
+    print("Checked %d incremental updates against full reruns:" % n_updates,
+          "%d mismatches" % n_wrong)
+    return n_wrong
+
+##############################################################################
+## History, baseline, and regressions
+##############################################################################
+
+def load_json(file_name, default):
+    """ Return contents of JSON file, or default if it doesn't exist. """
+    if not os.path.exists(file_name):
+        return default
+    with open(file_name) as file:
+        return json.load(file)
+
+def save_json(file_name, value):
+    """ Write value to JSON file. """
+    with open(file_name, "w") as file:
+        json.dump(value, file, indent=1, sort_keys=True)
+        file.write("\n")
+
+def find_regressions(results, baseline, tolerance, min_seconds):
+    """
+    Return list of (size, stage, baseline_seconds, seconds) for stages
+    slower than in baseline by more than a factor of (1+tolerance),
+    and by more than min_seconds.
+    """
+    regressions = []
+    for size, result in results.items():
+        if size not in baseline:
+            continue
+        for stage, t in result["seconds"].items():
+            t0 = baseline[size]["seconds"].get(stage)
+            if t0 is not None and t > t0*(1+tolerance) and t-t0 > min_seconds:
+                regressions.append((size, stage, t0, t))
+    return regressions
+
+def print_results(size, result):
+    """ Print timing results for one data set. """
+    print("%s: %d students, %d columns, total %.3fs, peak RSS %.1f MB"
+          % (size, result["n_stu"], result["n_col"],
+             result["total_seconds"], result["peak_rss_kb"]/1024.0))
+    for stage in STAGES:
+        print("    %20s %9.3fs %12.0f rows/s"
+              % (stage, result["seconds"][stage],
+                 result["rows_per_second"][stage]))
+
+def main():
+    """ Main routine. """
+    parser = argparse.ArgumentParser(\
+                description='Benchmark the student ranking program.')
+    parser.add_argument('--sizes',
+                        default=DEFAULT_SIZES,
+                        help='comma-separated list of sizes NxC '\
+                        '(N students, C components), e.g. 1000000x7,1000x500')
+    parser.add_argument('--seed', default=1,
+                        help='random number seed for make_data.py')
+    parser.add_argument('--repeat', default=1,
+                        help='number of runs per size (best time is kept)')
+    parser.add_argument('--data-dir', default='bench_data',
+                        help='directory for generated data sets')
+    parser.add_argument('--history', default='bench_history.json',
+                        help='JSON file to append results to')
+    parser.add_argument('--baseline', default='bench_baseline.json',
+                        help='JSON file of baseline results')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--tolerance', default=0.25,
+                        help='fractional slowdown flagged as regression')
+    parser.add_argument('--min-seconds', default=0.05,
+                        help='smaller slowdowns are never flagged')
+    parser.add_argument('--one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        # child process: time one data set, report as JSON
+        print(json.dumps(time_stages(args.one)))
+        return
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    mismatches = check_goldens(repo_dir)
+    incremental_mismatches = check_incremental(repo_dir)
+    approx_failures = check_approx(repo_dir)
+    drop_mismatches = check_drop()
+
+    seed = int(args.seed)
+    results = dict()
+    for size in args.sizes.split(","):
+        input_filename = data_file(args.data_dir, size, seed)
+        results[size] = run_one(input_filename, int(args.repeat))
+        print_results(size, results[size])
+
+    history = load_json(args.history, [])
+    history.append({"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "python": sys.version.split()[0],
+                    "seed": seed,
+                    "golden_mismatches": mismatches,
+                    "incremental_mismatches": incremental_mismatches,
+                    "approx_failures": approx_failures,
+                    "drop_mismatches": drop_mismatches,
+                    "results": results})
+    save_json(args.history, history)
+    print(args.history, "updated.")
+
+    baseline = load_json(args.baseline, dict())
+    regressions = find_regressions(results, baseline,
+                                   float(args.tolerance),
+                                   float(args.min_seconds))
+    for size, stage, t0, t in regressions:
+        print("  ** REGRESSION: %s %s %.3fs --> %.3fs" % (size, stage, t0, t))
+    if args.save_baseline:
+        baseline.update(results)
+        save_json(args.baseline, baseline)
+        print(args.baseline, "updated.")
+
+    if mismatches or incremental_mismatches or approx_failures \
+       or drop_mismatches or regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# columnar.py
+""" NumPy columnar representation of grade data, for large classes """
+# used by student ranking program rank.py (with --columnar)
+
+# This module needs numpy; rank.py works without it otherwise.
+
+import numpy as np
+
+import policy
+
+MISSING = "--"
+def ismissing(x):
+    """ Return True if x is MISSING. """
+    return x == MISSING
+
+class ColumnarState():
+    """
+    Columnar version of rank.State, consisting of:
+        an array of n_col column names
+        an array of n_col perfect_grade values (float64)
+        an array of n_col column weights (float64)
+        an n_stu x n_col matrix of grade or score data (float64)
+        an n_stu x n_col boolean mask, True where data is MISSING
+        a dict mapping each zero-weight column to its list of values
+            (student IDs etc. are kept "as is", as in rank.State)
+    Only weighted columns are held in the matrix; the matrix entries
+    for zero-weight columns and for MISSING data are NaN.
+    """
+    def __init__(self, names, perfect_grades, weights, matrix, missing, other):
+        self.names = np.asarray(names, dtype=object)
+        self.perfect_grades = np.asarray(perfect_grades, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.matrix = matrix
+        self.missing = missing
+        self.other = other
+
+        self.n_col = len(names)
+        self.columns = list(range(self.n_col))
+        self.n_stu = matrix.shape[0]
+        self.students = list(range(self.n_stu))
+
+        assert len(names) == len(perfect_grades)
+        assert len(names) == len(weights)
+        assert matrix.shape == (self.n_stu, self.n_col)
+        assert missing.shape == matrix.shape
+
+    def copy(self):
+        """ Return copy of this ColumnarState object. """
+        return ColumnarState(self.names, self.perfect_grades, self.weights,
+                             self.matrix.copy(), self.missing.copy(),
+                             {col: list(values)
+                              for col, values in self.other.items()})
+
+    def weighted_columns(self):
+        """ Return list of columns included in grade computation. """
+        return [col for col in self.columns if self.weights[col] > 0]
+
+def from_state(state):
+    """
+    Return ColumnarState for given rank.State (or rank.CowState).
+
+    Weighted columns are converted to floats as by rank.convert_data,
+    with data that doesn't convert to a float marked as MISSING; each
+    is copied into the matrix in bulk from its typed array and missing
+    mask (see rank.convert_column_typed).
+    """
+    matrix = np.full((state.n_stu, state.n_col), np.nan)
+    missing = np.zeros((state.n_stu, state.n_col), dtype=bool)
+    other = dict()
+    for col in state.columns:
+        if state.weights[col] > 0:
+            floats, mask = state.typed_column(col)
+            matrix[:, col] = np.frombuffer(floats, dtype=np.float64)
+            missing[:, col] = np.frombuffer(mask, dtype=bool)
+        else:
+            other[col] = list(state.column(col))
+    return ColumnarState(state.names, state.perfect_grades, state.weights,
+                         matrix, missing, other)
+
+def to_columns(cstate):
+    """
+    Return names, perfect_grades, weights and data columns for cstate,
+    in the column-list form used by rank.CowState.from_columns (floats,
+    or MISSING).
+    """
+    columns = []
+    for col in cstate.columns:
+        if col in cstate.other:
+            columns.append(list(cstate.other[col]))
+        else:
+            values = cstate.matrix[:, col].tolist()
+            for stu in np.flatnonzero(cstate.missing[:, col]).tolist():
+                values[stu] = MISSING
+            columns.append(values)
+    return (cstate.names.tolist(), cstate.perfect_grades.tolist(),
+            cstate.weights.tolist(), columns)
+
+def compute_beats(cstate):
+    """
+    Columnar version of rank.compute_beats.
+    Return beats (an n_stu x n_col matrix) and stu_per_comp.
+    """
+    beats = np.zeros((cstate.n_stu, cstate.n_col))
+    stu_per_comp = np.zeros(cstate.n_col, dtype=np.int64)
+    for col in cstate.weighted_columns():
+        present = ~cstate.missing[:, col]
+        stu_per_comp[col] = np.count_nonzero(present)
+        values = cstate.matrix[present, col]
+        ordered = np.sort(values)           # NaNs, if any, sort last
+        below = np.searchsorted(ordered, values, side='left')
+        upto = np.searchsorted(ordered, values, side='right')
+        col_beats = below + 0.5*(upto-below-1) + 1.0
+        # NaN is equal to and greater than nothing, so it only beats itself
+        col_beats[np.isnan(values)] = 1.0
+        beats[present, col] = col_beats
+    return beats, stu_per_comp
+
+def compute_scores(cstate, rank_weight=None):
+    """
+    Columnar version of rank.compute_scores.
+    """
+    beats, stu_per_comp = compute_beats(cstate)
+    return normalize_scores(cstate, beats, stu_per_comp, rank_weight)
+
+def normalize_scores(cstate, beats, stu_per_comp, rank_weight=None):
+    """
+    Columnar version of rank.normalize_scores.
+    """
+    if rank_weight is None:
+        rank_weight = policy.RANK_WEIGHT
+    new_cstate = cstate.copy()
+    for col in cstate.weighted_columns():
+        rank_value = beats[:, col] / (float(stu_per_comp[col]) + 1.0)
+        grade_value = cstate.matrix[:, col] / cstate.perfect_grades[col]
+        value = rank_weight*rank_value + (1-rank_weight)*grade_value
+        value[cstate.missing[:, col]] = np.nan
+        new_cstate.matrix[:, col] = value
+    return new_cstate
+
+def compute_wtd_scores(cstate):
+    """
+    Columnar version of policy.compute_wtd_scores.
+
+    Columns are accumulated one at a time in column order, just as
+    in policy.compute_wtd_scores, so the sums round identically.
+    """
+    total = np.zeros(cstate.n_stu)
+    total_weight = np.zeros(cstate.n_stu)
+    for col in cstate.weighted_columns():
+        w = cstate.weights[col]
+        present = ~cstate.missing[:, col]
+        total[present] += w * cstate.matrix[present, col]
+        total_weight[present] += w
+    wtd_score = np.zeros(cstate.n_stu)
+    graded = total_weight > 0
+    wtd_score[graded] = total[graded] / total_weight[graded]
+    return wtd_score.tolist()
+
+def rank_order(wtd_score):
+    """
+    Return students in the order rank.sort_state puts them in by the
+    given weighted scores: decreasing score, and students with equal
+    scores in decreasing order (as by sorted((ws, stu), reverse=True)).
+    """
+    wtd_score = np.asarray(wtd_score, dtype=np.float64)
+    return np.lexsort((-np.arange(len(wtd_score)), -wtd_score)).tolist()
+
+def drop(cstate, plan):
+    """
+    Columnar version of policy.drop, applying a compiled policy.DropPlan
+    (see policy.compile_drop_policy) to all students at once.
+    The columns of the drop policy items must be weighted columns.
+    """
+    new_cstate = cstate.copy()
+    if not plan.active:
+        return new_cstate
+    matrix = new_cstate.matrix
+    missing = new_cstate.missing
+    # scores of -1 are made MISSING, just as by policy.drop
+    missing |= (matrix == -1)
+    rows = np.arange(cstate.n_stu)[:, np.newaxis]
+    for k, cols in plan.items:
+        if any(col in cstate.other for col in cols):
+            raise ValueError("drop policy columns must be weighted: "
+                             + " ".join(cstate.names[cols]))
+        cols = np.asarray(cols)
+        # MISSING counts as lowest; stable sort drops ties in policy order
+        keys = np.where(missing[:, cols], -1.0, matrix[:, cols])
+        lowest = np.argsort(keys, axis=1, kind='stable')[:, :k]
+        missing[rows, cols[lowest]] = True
+    for col, last in plan.duplicates:
+        matrix[:, col] = matrix[:, last]
+        missing[:, col] = missing[:, last]
+        if last in new_cstate.other:
+            new_cstate.other[col] = list(new_cstate.other[last])
+    matrix[missing] = np.nan
+    return new_cstate
@@ -0,0 +1,178 @@
+# gradebook.py
+""" compact binary gradebook format, loaded by memory-mapping """
+# used by student ranking program rank.py
+
+# This module needs numpy; rank.py works without it otherwise.
+
+"""
+A gradebook file holds a converted grade state (as returned by
+rank.read_grades) so that it can be loaded again without parsing
+CSV text or converting strings to floats.  To convert a CSV file:
+
+    python3 gradebook.py grades.csv            # writes grades.csv.gradebook
+    python3 rank.py grades.csv.gradebook       # ranks as for grades.csv
+
+The file layout (all numbers little-endian) is:
+
+    magic       8 bytes, MAGIC
+    hlen        8 bytes, unsigned: length of header in bytes
+    header      hlen bytes of JSON (space-padded to a multiple of 8):
+                    {"n_stu": ..., "names": [...],
+                     "perfect_grades": [...], "weights": [...]}
+    data        n_col columns of n_stu float64 values, column after
+                column; NaN for MISSING data and zero-weight columns
+    missing     n_col bitmaps of ceil(n_stu/8) bytes, one bit per
+                student (least significant bit first); 1 if MISSING
+    text        for each zero-weight column, each student's value
+                (e.g. a student ID), in UTF-8, followed by a NUL byte
+
+load_columnar maps the data straight into the matrix of a
+columnar.ColumnarState, without reading or copying it; only the
+missing bitmaps are unpacked, and the text columns decoded.
+"""
+
+import argparse
+import json
+
+import numpy as np
+
+import columnar
+import rank
+
+MAGIC = b"RANKGB\x00\x01"
+
+MISSING = "--"
+
+def is_gradebook(file_name):
+    """ Return True if file_name is a gradebook file (not CSV). """
+    with open(file_name, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+def write_gradebook(state, file_name):
+    """
+    Write state (whose data has been converted, as by rank.read_grades)
+    to gradebook file file_name.
+    """
+    header = json.dumps({"n_stu": state.n_stu,
+                         "names": list(state.names),
+                         "perfect_grades": list(state.perfect_grades),
+                         "weights": list(state.weights)}).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+    n_bytes = (state.n_stu + 7) // 8
+    with open(file_name, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.uint64(len(header)).astype("<u8").tobytes())
+        file.write(header)
+        missing = []
+        for col in state.columns:
+            if state.weights[col] > 0:
+                floats, mask = state.typed_column(col)
+                values = np.frombuffer(floats, dtype=np.float64).astype("<f8")
+                is_missing = np.frombuffer(mask, dtype=bool)
+            else:
+                is_missing = np.zeros(state.n_stu, dtype=bool)
+                values = np.full(state.n_stu, np.nan, dtype="<f8")
+            file.write(values.tobytes())
+            missing.append(np.packbits(is_missing, bitorder="little"))
+        for bits in missing:
+            file.write(bits.tobytes())
+            file.write(b"\x00" * (n_bytes - len(bits)))
+        for col in state.columns:
+            if state.weights[col] <= 0:
+                texts = [str(d) for d in state.column(col)]
+                if any("\x00" in text for text in texts):
+                    raise ValueError("NUL character in column "
+                                     + state.names[col])
+                file.write("".join(text + "\x00"
+                                   for text in texts).encode("utf-8"))
+
+def _open(file_name):
+    """
+    Return header and memory map of gradebook file_name, and the offset
+    of its data section.
+    """
+    raw = np.memmap(file_name, dtype=np.uint8, mode="r")
+    if bytes(raw[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not a gradebook file: " + file_name)
+    start = len(MAGIC) + 8
+    hlen = int(raw[len(MAGIC):start].view("<u8")[0])
+    header = json.loads(bytes(raw[start:start+hlen]).decode("utf-8"))
+    return header, raw, start + hlen
+
+def load_columnar(file_name):
+    """
+    Return columnar.ColumnarState for gradebook file_name.  Its matrix
+    is a read-only view of the memory-mapped file (columnar functions
+    return new states rather than modifying their inputs).
+    """
+    header, raw, offset = _open(file_name)
+    names = header["names"]
+    n_stu = header["n_stu"]
+    n_col = len(names)
+    data_bytes = 8 * n_stu * n_col
+    matrix = raw[offset:offset+data_bytes].view("<f8") \
+                 .reshape(n_col, n_stu).T
+    offset += data_bytes
+    n_bytes = (n_stu + 7) // 8
+    bits = raw[offset:offset + n_bytes*n_col].reshape(n_col, n_bytes)
+    missing = np.unpackbits(bits, axis=1, count=n_stu,
+                            bitorder="little").T.astype(bool)
+    offset += n_bytes*n_col
+    other = dict()
+    texts = bytes(raw[offset:]).decode("utf-8").split("\x00")
+    for col, weight in enumerate(header["weights"]):
+        if weight <= 0:
+            other[col] = texts[:n_stu]
+            texts = texts[n_stu:]
+    return columnar.ColumnarState(names, header["perfect_grades"],
+                                  header["weights"], matrix, missing, other)
+
+def load_state(file_name):
+    """
+    Return rank.CowState for gradebook file_name, with the same data
+    as rank.read_grades gives for the CSV file it was made from.
+    """
+    return to_state(load_columnar(file_name))
+
+def to_state(cstate):
+    """
+    Return rank.CowState with the data of columnar.ColumnarState cstate
+    (floats, or MISSING).  Its weighted columns are rank.TypedColumns
+    whose floats are views of cstate's matrix (for a gradebook, of the
+    memory-mapped file), so nothing is copied but the missing masks;
+    lists are only built for the stages that ask for them.
+    """
+    cols = []
+    for col in cstate.columns:
+        if col in cstate.other:
+            cols.append(cstate.other[col])
+        else:
+            floats = np.ascontiguousarray(cstate.matrix[:, col],
+                                          dtype=np.float64)
+            cols.append(rank.TypedColumn(memoryview(floats),
+                                         bytearray(cstate.missing[:, col])))
+    return rank.CowState.from_columns(cstate.names.tolist(),
+                                      cstate.perfect_grades.tolist(),
+                                      cstate.weights.tolist(), cols)
+
+def main():
+    """ Main routine: convert CSV file to gradebook file. """
+    parser = argparse.ArgumentParser(\
+                description='Convert CSV grade file to a binary gradebook.')
+    parser.add_argument('input_filename',
+                        help='csv file, in the format read by rank.py')
+    parser.add_argument('--skiprows', default=0,
+                        help='number of rows to skip before header row')
+    parser.add_argument('--output',
+                        help='gradebook file to write '\
+                        '(default: INPUT_FILENAME.gradebook)')
+    args = parser.parse_args()
+
+    print("Reading input file:", args.input_filename)
+    grade_state = rank.read_grades(args.input_filename, int(args.skiprows))
+    output_filename = args.output or args.input_filename + ".gradebook"
+    write_gradebook(grade_state, output_filename)
+    print(output_filename, "written.")
+
+if __name__ == "__main__":
+    main()
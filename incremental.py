@@ -0,0 +1,294 @@
+# incremental.py
+""" incremental re-ranking of students when single grades change """
+# used with student ranking program rank.py
+
+"""
+An IncrementalRanking is built once from a converted grade state
+(as returned by rank.convert_data), and then kept up to date as
+single grades are changed (e.g. after a regrade), without redoing
+the whole ranking.
+
+Scores and weighted scores are computed exactly as by
+rank.compute_scores and policy.compute_wtd_scores, and the order
+is that given by rank.sort_state on the weighted scores (before any
+policy.drop), so the results always agree with a full rerun
+(check_random_updates checks this).  Grades must be finite: a NaN
+grade would make a weighted score NaN, which has no place in the
+order, so NaN and infinite grades are rejected with ValueError.
+"""
+
+import bisect
+import math
+import random
+
+import policy
+import rank
+
+MISSING = "--"
+def ismissing(x):
+    """ Return True if x is MISSING. """
+    return x == MISSING
+
+def convert_to_float_if_possible(x, elsevalue=MISSING):
+    """ Return float version of value x, else elsevalue. """
+    try:
+        return float(x)
+    except ValueError:
+        return elsevalue
+
+INF = float("inf")
+
+def check_grade(d, grade):
+    """
+    Raise ValueError if converted grade d (given as grade) is NaN or
+    infinite.
+    """
+    if not ismissing(d) and not math.isfinite(d):
+        raise ValueError("grade must be finite (or missing): %r" % (grade,))
+
+class IncrementalRanking():
+    """
+    Ranking of students, maintained under single-grade updates.
+
+    For each weighted column we keep a sorted list of (grade, stu)
+    pairs for the students having (non-NaN) grades there, from which
+    a student's beats count is found by binary search.  The students
+    are kept in a sorted list of (wtd_score, stu) pairs, which gives
+    their order, best last.
+    """
+    def __init__(self, grade_state):
+        self.names = list(grade_state.names)
+        self.perfect_grades = list(grade_state.perfect_grades)
+        self.weights = list(grade_state.weights)
+        self.n_col = grade_state.n_col
+        self.columns = list(range(self.n_col))
+        self.n_stu = grade_state.n_stu
+        self.students = list(range(self.n_stu))
+        self.weighted_columns = [col for col in self.columns
+                                 if self.weights[col] > 0]
+
+        self.grades = [list(grade_state.column(col)) for col in self.columns]
+        for col in self.weighted_columns:
+            for d in self.grades[col]:
+                check_grade(d, d)
+        self.scores = [list(values) for values in self.grades]
+        self.stu_per_comp = [0 for col in self.columns]
+        self.sorted_grades = [[] for col in self.columns]
+        for col in self.weighted_columns:
+            for stu, d in enumerate(self.grades[col]):
+                if not ismissing(d):
+                    self.stu_per_comp[col] += 1
+                    if d == d:          # i.e. not NaN
+                        self.sorted_grades[col].append((d, stu))
+            self.sorted_grades[col].sort()
+            for stu in self.students:
+                self._update_score(stu, col)
+
+        self.wtd_scores = [0.0 for stu in self.students]
+        for stu in self.students:
+            self._update_wtd_score(stu)
+        self.order_keys = sorted([(ws, stu)
+                                  for stu, ws in enumerate(self.wtd_scores)])
+
+    def beats(self, stu, col):
+        """
+        Return number of students stu beats in column col, as in
+        rank.compute_beats (one for himself, one-half for each tie).
+        """
+        d = self.grades[col][stu]
+        if ismissing(d):
+            return 0
+        if d != d:
+            return 1.0
+        L = self.sorted_grades[col]
+        below = bisect.bisect_left(L, (d, -1))
+        upto = bisect.bisect_right(L, (d, INF))
+        return below + 0.5*(upto-below-1) + 1.0
+
+    def _update_score(self, stu, col):
+        """ Recompute score of stu in column col, as in rank.normalize_scores. """
+        d = self.grades[col][stu]
+        if ismissing(d):
+            self.scores[col][stu] = MISSING
+            return
+        rank_weight = policy.RANK_WEIGHT
+        rank_value = self.beats(stu, col) / (float(self.stu_per_comp[col]) + 1.0)
+        grade_value = d / self.perfect_grades[col]
+        self.scores[col][stu] = \
+            rank_weight*rank_value + (1-rank_weight)*grade_value
+
+    def _update_wtd_score(self, stu):
+        """ Recompute weighted score of stu, as in policy.compute_wtd_scores. """
+        total = 0.0
+        total_weight = 0.0
+        for col in self.weighted_columns:
+            d = self.scores[col][stu]
+            if not ismissing(d):
+                total += self.weights[col] * d
+                total_weight += self.weights[col]
+        if total_weight > 0:
+            self.wtd_scores[stu] = total / total_weight
+        else:
+            self.wtd_scores[stu] = 0.0
+
+    def order(self):
+        """ Return list of students in rank order (best first). """
+        return [stu for (ws, stu) in reversed(self.order_keys)]
+
+    def rank(self, stu):
+        """ Return rank of student stu (1 for best). """
+        key = (self.wtd_scores[stu], stu)
+        return self.n_stu - bisect.bisect_left(self.order_keys, key)
+
+    def update(self, stu, col, grade):
+        """
+        Change grade of student stu in column col to grade (a number,
+        or anything non-numeric for MISSING), and re-rank.  Raise
+        ValueError, changing nothing, if grade is NaN or infinite.
+
+        Only the scores in column col that depend on the changed grade
+        are recomputed: those of students whose grades lie between the
+        old and new grade, or all of them if the number of students
+        with a grade in the column changes.
+
+        Return list of (stu, old_rank, new_rank) for each student whose
+        rank changed, in order of new rank.
+        """
+        if self.weights[col] <= 0:
+            # not part of grade; kept "as is", as by rank.convert_data
+            self.grades[col][stu] = grade
+            self.scores[col][stu] = grade
+            return []
+        old = self.grades[col][stu]
+        new = convert_to_float_if_possible(grade)
+        check_grade(new, grade)
+        self.grades[col][stu] = new
+
+        L = self.sorted_grades[col]
+        if not ismissing(old) and old == old:
+            del L[bisect.bisect_left(L, (old, stu))]
+        if not ismissing(new) and new == new:
+            bisect.insort(L, (new, stu))
+
+        if ismissing(old) != ismissing(new):
+            # divisor changes, so everyone's score in column changes
+            self.stu_per_comp[col] += 1 if ismissing(old) else -1
+            affected = [s for s in self.students
+                        if not ismissing(self.grades[col][s])]
+            if ismissing(new):
+                affected.append(stu)
+        else:
+            # only students with grades between old and new grade
+            affected = set([stu])
+            bounds = [x for x in (old, new) if not ismissing(x) and x == x]
+            if bounds:
+                lo = bisect.bisect_left(L, (min(bounds), -1))
+                hi = bisect.bisect_right(L, (max(bounds), INF))
+                affected.update(s for (d, s) in L[lo:hi])
+
+        moved = []
+        for s in affected:
+            self._update_score(s, col)
+            old_ws = self.wtd_scores[s]
+            self._update_wtd_score(s)
+            if self.wtd_scores[s] != old_ws:
+                moved.append((old_ws, s))
+        old_keys = list(self.order_keys)
+        positions = []
+        for (old_ws, s) in moved:
+            positions.append(bisect.bisect_left(old_keys, (old_ws, s)))
+            del self.order_keys[bisect.bisect_left(self.order_keys,
+                                                   (old_ws, s))]
+            bisect.insort(self.order_keys, (self.wtd_scores[s], s))
+        for (old_ws, s) in moved:
+            positions.append(bisect.bisect_left(self.order_keys,
+                                                (self.wtd_scores[s], s)))
+        return self._rank_diff(old_keys, positions)
+
+    def _rank_diff(self, old_keys, positions):
+        """
+        Return (stu, old_rank, new_rank) for students whose rank changed.
+        Here positions are the old and new positions of the students
+        whose weighted scores changed; no other student can move outside
+        the range between min(positions) and max(positions).
+        """
+        if not positions:
+            return []
+        old_rank = dict()
+        new_rank = dict()
+        for i in range(min(positions), max(positions)+1):
+            old_rank[old_keys[i][1]] = self.n_stu - i
+            new_rank[self.order_keys[i][1]] = self.n_stu - i
+        return sorted([(s, old_rank[s], new_rank[s]) for s in new_rank
+                       if old_rank[s] != new_rank[s]],
+                      key=lambda x: x[2])
+
+def check_random_updates(grade_state, n_updates=100, seed=1):
+    """
+    Make n_updates random single-grade updates to an IncrementalRanking
+    of grade_state (converted, as by rank.read_grades): new grades,
+    grades tied with another student's, MISSING grades, and rejected
+    NaN grades.  After each, compare its order, ranks, scores, weighted
+    scores and rank diff with a full rank.rank_pipeline rerun on its
+    grades.  Return number of updates after which they differ.
+    """
+    rng = random.Random(seed)
+    ranking = IncrementalRanking(grade_state)
+    if not ranking.weighted_columns or ranking.n_stu == 0:
+        return 0
+    ranks = [ranking.rank(stu) for stu in ranking.students]
+    mismatches = 0
+    for _ in range(n_updates):
+        stu = rng.randrange(ranking.n_stu)
+        col = rng.choice(ranking.weighted_columns)
+        kind = rng.randrange(8)
+        if kind == 0:
+            grade = MISSING
+        elif kind == 1:
+            grade = "nan"
+        elif kind <= 3:
+            grade = ranking.grades[col][rng.randrange(ranking.n_stu)]
+        else:
+            grade = round(rng.uniform(0, ranking.perfect_grades[col]), 1)
+        try:
+            diff = ranking.update(stu, col, grade)
+        except ValueError:
+            diff = []
+        new_ranks = [ranking.rank(stu) for stu in ranking.students]
+        expected_diff = sorted([(s, ranks[s], new_ranks[s])
+                                for s in ranking.students
+                                if ranks[s] != new_ranks[s]],
+                               key=lambda x: x[2])
+        ranks = new_ranks
+        if diff != expected_diff \
+           or not _agrees_with_rerun(ranking):
+            mismatches += 1
+    return mismatches
+
+def _agrees_with_rerun(ranking):
+    """
+    Return True if ranking agrees with a full rank.rank_pipeline rerun
+    on its grades.
+    """
+    state = rank.CowState.from_columns(ranking.names, ranking.perfect_grades,
+                                       ranking.weights,
+                                       [list(values)
+                                        for values in ranking.grades])
+    result = rank.rank_pipeline(state, policy)
+    score_state = result.score_state
+    order = ranking.order()
+    wtd_col = score_state.names.index("wtd_score")
+    rank_col = score_state.names.index("rank")
+    if score_state.column(wtd_col) != [ranking.wtd_scores[stu]
+                                       for stu in order]:
+        return False
+    if score_state.column(rank_col) != [ranking.rank(stu) for stu in order]:
+        return False
+    for col in ranking.weighted_columns:
+        if score_state.column(col) != [ranking.scores[col][stu]
+                                       for stu in order]:
+            return False
+        if result.grade_state.column(col) != [ranking.grades[col][stu]
+                                              for stu in order]:
+            return False
+    return True
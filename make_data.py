@@ -1,7 +1,7 @@
 # routine to make test data for GBV (Grading By Voting) program
 # Ronald L. Rivest
 # 5/13/17
-# python2
+# python2 or python3
 
 """
 Minor note: having "ID" as the contents of row 0, col 0 
@@ -10,8 +10,11 @@ as SYLK rather than CSV.  So, we use "STU_ID" rather than "ID"
 in the header row.
 """
 
+from __future__ import print_function
+
 import argparse
 import random
+import sys
 
 MISSING = " --"
 
@@ -25,16 +28,14 @@ def rand_score(mu, max_score, frac_missing):
     x = min(max_score,max(0,x))
     return "%3d"%int(x)
 
-def main():
-    parser = argparse.ArgumentParser(description='Produce sample data set for use by GBV, a voting-based program to order students based on their performance on homeworks, quizzes, and a final exam.')
-    parser.add_argument('n_students',help='number of students records to produce')
-    parser.add_argument('--seed',help='random number seed',default=1)
-    args = parser.parse_args()
+def make_rows(n_students, n_homeworks=4, seed=1):
+    """
+    Return list of rows (lists of strings) of a sample data set:
+    header row, perfect_grades row, weight row, and one row per student.
+    """
     n_IDs = 1
-    n_homeworks = 4
     n_quizzes = 2
     n_finals = 1
-    n_students = int(args.n_students)
     max_homework_score = 10
     max_quiz_score = 100
     max_final_score = 200
@@ -42,7 +43,7 @@ def main():
     frac_quizzes_missing = 0.10
     frac_final_missing = 0.0
     
-    random.seed(int(args.seed))
+    random.seed(int(seed))
 
     DQ = '\"'
     DQC = DQ+","
@@ -103,11 +104,23 @@ def main():
         for i, datum in enumerate(row):
             column_widths[i] = max(column_widths[i], len(str(datum)))
 
-    for row in all_data:
-        for i, datum in enumerate(row):
-            print ("%" + str(column_widths[i]) + "s")%datum,
-            if i< len(row)-1:
-                print ",",
-        print
+    return [[("%" + str(column_widths[i]) + "s")%datum
+             for i, datum in enumerate(row)]
+            for row in all_data]
+
+def write_rows(rows, file):
+    """ Write rows produced by make_rows to file, as CSV. """
+    for row in rows:
+        file.write(" , ".join(row) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description='Produce sample data set for use by GBV, a voting-based program to order students based on their performance on homeworks, quizzes, and a final exam.')
+    parser.add_argument('n_students',help='number of students records to produce')
+    parser.add_argument('--seed',help='random number seed',default=1)
+    parser.add_argument('--homeworks',help='number of homeworks',default=4)
+    args = parser.parse_args()
+    rows = make_rows(int(args.n_students), int(args.homeworks), args.seed)
+    write_rows(rows, sys.stdout)
 
-main()
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ Kemeny-Young score for that permutation
 """ (Distributed under MIT License) """
 
 import argparse
+import array
 import csv
 import math
 import random
@@ -20,6 +21,12 @@ import sys
 import time
 
 import kem                       # methods for minimizing Kemeny score
+try:
+    import numpy as np           # optional, for make_preference_matrix
+except ImportError:
+    np = None
+
+EXACT_MAX_STUDENTS = 18          # classes this small are ranked exactly (kem.SDP)
 
 ##############################################################################
 ## Beginning of "grading by voting" method
@@ -110,10 +117,86 @@ def print_grade_components(name_row, weight_row):
         else:
             print "------"
 
+TILE_BYTES = 1<<26               # bytes per tile of entries (numpy version)
+
 def make_preference_matrix(weight_row, data_rows):
     """
     weight_row = list of weights for components (may be 0 or missing)
     data_rows = actual data matrix (list of rows)
+    A[i1][i2] is the total weight of the components in which student i1
+    has a (non-missing) score greater than student i2.
+    Uses make_preference_matrix_numpy if numpy is available.
+    """
+    if np is not None:
+        return make_preference_matrix_numpy(weight_row, data_rows)
+    return make_preference_matrix_lists(weight_row, data_rows)
+
+def make_preference_matrix_numpy(weight_row, data_rows):
+    """
+    Same as make_preference_matrix_lists, but built with numpy, and
+    returned as a list of rows, each an array.array, which kem reads
+    entry by entry about as fast as a list, at 4 (or 8) bytes per entry.
+    (gbv.py itself runs under Python 2, where numpy is usually not
+    installed; this version has been checked against the list version
+    under Python 3.)
+
+    Each column's scores are sorted (np.unique) and replaced by their
+    ranks among the distinct scores, so that comparing two students is
+    comparing two small integers.  A missing (or NaN) score gets rank
+    -1 as the first of a pair, and a rank above all others as the second,
+    so it is never greater nor less than another score.  The matrix is
+    filled a tile of rows at a time, by broadcasting each tile's ranks
+    against all the students' ranks, so at most about TILE_BYTES of
+    tile entries (and fewer of comparisons) exist at once.
+
+    Each tile is copied into its rows as soon as it is filled, so the
+    whole matrix is only held once, as rows.  The entries are int32 if
+    all weights are whole numbers (4 bytes per entry, a quarter of a
+    list of Python floats), else float64 (with sums in the same order as
+    make_preference_matrix_lists, so equal to them).
+    """
+    n_stu = len(data_rows)
+    n_cols = len(weight_row)
+    weights = [convert_to_float_if_possible(weight_row[col], 0)
+               for col in range(n_cols)]
+    graded = [col for col in range(n_cols) if weights[col] > 0]
+    if all(float(weights[col]).is_integer() for col in graded) \
+       and sum(weights[col] for col in graded) < 2**31:
+        dtype, typecode = np.int32, 'i'
+        weights = [int(weights[col]) if col in graded else 0
+                   for col in range(n_cols)]
+    else:
+        dtype, typecode = np.float64, 'd'
+    first_ranks = []         # ranks of scores, as first of a pair
+    second_ranks = []        # ranks of scores, as second of a pair
+    for col in graded:
+        scores = np.array([np.nan if ismissing(row[col]) else row[col]
+                           for row in data_rows], dtype=np.float64)
+        present = ~np.isnan(scores)
+        distinct, ranks = np.unique(scores[present], return_inverse=True)
+        first = np.full(n_stu, -1, dtype=np.int32)
+        first[present] = ranks
+        second = np.full(n_stu, len(distinct), dtype=np.int32)
+        second[present] = ranks
+        first_ranks.append(first)
+        second_ranks.append(second)
+
+    A = [ ]
+    tile_rows = max(1, TILE_BYTES // (8 * max(1, n_stu)))
+    for start in range(0, n_stu, tile_rows):
+        stop = min(n_stu, start + tile_rows)
+        tile = np.zeros((stop - start, n_stu), dtype=dtype)
+        for i, col in enumerate(graded):
+            greater = first_ranks[i][start:stop, None] > second_ranks[i][None, :]
+            np.add(tile, weights[col], out=tile, where=greater)
+        for row in tile:
+            A.append(array.array(typecode, row.tobytes()))
+    return A
+
+def make_preference_matrix_lists(weight_row, data_rows):
+    """
+    Version of make_preference_matrix without numpy: list of lists,
+    filled by comparing all pairs of students in each column.
     """
     n_rows = len(data_rows)
     n_stu = n_rows                    # number of rows = number of students
@@ -256,6 +339,21 @@ def main():
                 'number of minutes to spend optimizing student order')
     parser.add_argument('--skiprows',default=0,help=\
                 'number of rows to skip before header row')
+    parser.add_argument('--local-search',default='first',
+                choices=['first','best','none'],help=\
+                'local search strategy for polishing the initial order '\
+                '(first- or best-improvement), before split-merge')
+    parser.add_argument('--jobs',default=1,help=\
+                'number of worker processes; if more than one, optimize with '\
+                'parallel split-merge chains (see kem.parallel_search)')
+    parser.add_argument('--chains',default=None,help=\
+                'number of parallel search chains (default: JOBS); fix it '\
+                'to get the same result with any number of jobs')
+    parser.add_argument('--seed',default=1,help=\
+                'master random number seed (for dc and parallel search)')
+    parser.add_argument('--rounds',default=None,help=\
+                'number of rounds of parallel search (instead of opt_minutes), '\
+                'e.g. to reproduce an earlier run')
     args = parser.parse_args()
 
     input_filename = args.input_filename
@@ -275,12 +373,50 @@ def main():
 
     A = make_preference_matrix(weight_row, data_rows)
 
-    best_stu_order, best_rating = kem.dc(A)
+    if n_stu <= EXACT_MAX_STUDENTS:
+        # small class: solve exactly, no fine tuning needed
+        best_stu_order, best_rating = kem.SDP(A)
+        print "Optimal student order found by exact solver (SDP)."
+        opt_minutes = 0.0
+    else:
+        random.seed(int(args.seed))
+        best_stu_order, best_rating = kem.dc(A)
+        opt_minutes = float(args.opt_minutes)
+        print "Now %.0f minutes of optimizing (fine tuning)... "\
+              "initial Kemeny score is %.0f"%(opt_minutes, best_rating)
     orig_order = best_stu_order
-    opt_minutes = float(args.opt_minutes)
-    print "Now %.0f minutes of optimizing (fine tuning)... "\
-          "initial Kemeny score is %.0f"%(opt_minutes, best_rating)
+    jobs = int(args.jobs)
+    if (jobs > 1 or args.rounds != None) and n_stu > EXACT_MAX_STUDENTS:
+        # chains from the dc order, the Borda order and the reversed dc order
+        borda_order, _, _ = borda(list(name_row), list(weight_row),
+                                  [list(row) for row in data_rows])
+        starts = [best_stu_order, borda_order, best_stu_order[::-1]]
+        seed = int(args.seed)
+        chains = jobs
+        if args.chains != None:
+            chains = int(args.chains)
+        rounds = None
+        if args.rounds != None:
+            rounds = int(args.rounds)
+        print "Parallel search: %d chains, %d jobs, seed %d"%(chains, jobs, seed)
+        def progress(rnd, rating):
+            print "(round %4d) --> %.0f"%(rnd, rating)
+        best_stu_order, best_rating, rounds = \
+            kem.parallel_search(A, starts, jobs, seed, opt_minutes*60.0,
+                                rounds, 10, progress, chains)
+        print "(%d changes total; %d rounds, rerun with --chains %d --seed %d "\
+              "--rounds %d to reproduce)"\
+              %(len(best_stu_order)-LCS(best_stu_order, orig_order),
+                rounds, chains, seed, rounds)
+        opt_minutes = 0.0
     t0 = time.time()
+    if args.local_search != 'none' and opt_minutes > 0:
+        best_stu_order, best_rating, trajectory = \
+            kem.local_search(A, best_stu_order, args.local_search,
+                             opt_minutes*60.0, best_rating)
+        print "Local search (%s improvement):"%args.local_search
+        for seconds, rating in trajectory[1:]:
+            print "  (%7.2fs) --> %.0f"%(seconds, rating)
     i = 0
     while (time.time()-t0)/60.0 < opt_minutes:
         i += 1
@@ -24,9 +24,14 @@ Some of our heuristics (e.g. those based on the dynamic programming
 approch in "merge", may be new.
 """
 
+import array
+import ctypes
 import itertools
 import math
+import multiprocessing
+import multiprocessing.sharedctypes
 import random
+import time
 
 def K(A,L=None):
     """ 
@@ -104,6 +109,94 @@ def test_BF():
 
 test_BF()
 
+##############################################################################
+## exact solution by dynamic programming over subsets (SDP)
+##############################################################################
+
+def contribution_tables(A, L, z):
+    """
+    Return tables lo, hi for element L[z], giving the preference for a
+    subset S of the elements of L over L[z]:
+        sum_{x in S} A[L[x]][L[z]] == lo[S & lomask] + hi[S >> h]
+    where subsets S are bitmasks over positions in L, h is len(L)//2,
+    and lomask is (1<<h)-1.  Each table has O(2^(len(L)/2)) entries.
+    """
+    m = len(L)
+    h = m//2
+    col = [A[x][L[z]] for x in L]
+    lo = [0 for s in range(1<<h)]
+    for s in range(1, 1<<h):
+        low = s & -s
+        lo[s] = lo[s ^ low] + col[low.bit_length()-1]
+    hi = [0 for s in range(1<<(m-h))]
+    for s in range(1, 1<<(m-h)):
+        low = s & -s
+        hi[s] = hi[s ^ low] + col[h + low.bit_length()-1]
+    return lo, hi
+
+def SDP(A, L=None):
+    """
+    Solve the K-maximization problem exactly, by dynamic programming
+    over subsets.  Here A is an m x m matrix, and L is a subset of
+    range(m).  Return best permutation and its K-value (the same K-value
+    as BF, though perhaps another permutation with that value).
+
+    F[S] is the best K-value of an order of the elements of L at the
+    positions in bitmask S; such an order ends with some L[z], after
+    the elements of S-{z} in their best order, so
+        F[S] = max_{z in S} F[S-{z}] + sum_{x in S-{z}} A[L[x]][L[z]]
+    where the sum is found in O(1) time from contribution_tables.
+    This takes O(2^n * n) time and O(2^n) space for n = len(L): in
+    pure Python, a few seconds for n = 20, but minutes and GBs for n = 25.
+    """
+    if L==None:
+        L = range(len(A))
+    n = len(L)
+    if n < 2:
+        return list(L), 0
+    h = n//2
+    lomask = (1<<h)-1
+    tables = [contribution_tables(A, L, z) for z in range(n)]
+    bits = [(1<<z, z, tables[z][0], tables[z][1]) for z in range(n)]
+    F = [0 for S in xrange(1<<n)]
+    last = array.array('b', [0]) * (1<<n)  # z of best last element L[z]
+    for S in xrange(1, 1<<n):
+        best = None
+        for bit, z, lo, hi in bits:
+            if S & bit:
+                R = S ^ bit
+                value = F[R] + lo[R & lomask] + hi[R >> h]
+                if best is None or value > best:
+                    best = value
+                    best_z = z
+        F[S] = best
+        last[S] = best_z
+    # backtrack from the full set
+    order = [ ]            # accumulate in reverse order
+    S = (1<<n)-1
+    while S:
+        z = last[S]
+        order.append(L[z])
+        S = S ^ (1<<z)
+    order.reverse()
+    return order, F[(1<<n)-1]
+
+def test_SDP():
+    """ Test SDP against BF """
+    m = 9
+    A = test_A(m, 1)
+    best_p, best_K = SDP(A)
+    assert tuple(best_p) == (5, 4, 6, 0, 3, 7, 8, 1, 2)
+    assert best_K == 27047279315230
+    for m in range(1, 8):
+        A = test_A(m, 2)
+        L = range(m-1, -1, -1)
+        best_p, best_K = SDP(A, L)
+        assert sorted(best_p) == sorted(L)
+        assert best_K == K(A, best_p) == BF(A, L)[1]
+
+test_SDP()
+
 ##############################################################################
 ## implementation of Tideman's ranked pairs voting method (RP)
 ## https://en.wikipedia.org/wiki/Ranked_pairs
@@ -244,9 +337,98 @@ def merge(A, L, M):
     L and M are disjoint subsets of range(m)
     Return the merge N of L and M with maximum K value.
 
-    This is a dynamic-programming algorithm. O(m^3) time.
+    This is a dynamic-programming algorithm. O(m^2) time.
     The formulation of this "merge" proglem and the use of dynamic
     programming to solve it may be the most novel aspect of our approach.
+
+    Each entry of the dynamic-programming matrix takes O(1) time, using
+    running sums of the preferences between L[i-1] (or M[j-1]) and the
+    elements placed ahead of it.  The result is the same as that of
+    merge_cubic (which computes the same sums from scratch for each
+    entry), ties included, as long as the sums are exact (e.g. for
+    integer, or integer-valued, preferences).
+    """
+    m = len(A)
+    nL = len(L)
+    nM = len(M)
+    if nL == 0:
+        return M
+    if nM == 0:
+        return L
+    # inL[i] is the preference for L[:i-1] over L[i-1]: sum_{x in L[:i-1]} A[x][L[i-1]]
+    # inM[j] likewise for M[:j-1] over M[j-1]
+    inL = [0 for i in range(nL+1)]
+    for i in range(1, nL+1):
+        z = L[i-1]
+        inL[i] = sum([A[x][z] for x in L[:i-1]])
+    inM = [0 for j in range(nM+1)]
+    for j in range(1, nM+1):
+        z = M[j-1]
+        inM[j] = sum([A[y][z] for y in M[:j-1]])
+    # Dynamic programming
+    # B[i][j] is best (largest) K-value for merge of L[:i],M[:j]
+    # C[i][j] indicates choice made to achieve that value ('L' or 'M' last)
+    B = [[0 for j in range(nM+1)] for i in range(nL+1)]
+    C = [['-' for j in range(nM+1)] for i in range(nL+1)]
+    # fill in first row: B[0][j] is K(A,M[:j])
+    for j in range(1, nM+1):
+        B[0][j] = B[0][j-1] + inM[j]
+        C[0][j] = 'M'
+    # fill in first column: B[i][0] is K(A,L[:i])
+    for i in range(1, nL+1):
+        B[i][0] = B[i-1][0] + inL[i]
+        C[i][0] = 'L'
+    # upper-left entry, though, has no predecessor
+    C[0][0] = '-'
+    # fill in bulk of matrix, one row at a time
+    # LtoM[j] is the preference for L[:i] over M[j-1]: sum_{x in L[:i]} A[x][M[j-1]]
+    LtoM = [0 for j in range(nM+1)]
+    for i in range(1, nL+1):
+        z = L[i-1]
+        Az = A[z]
+        Bi = B[i]
+        Bi1 = B[i-1]
+        Ci = C[i]
+        inLi = inL[i]
+        MtoL = 0        # preference for M[:j] over L[i-1]
+        for j in range(1, nM+1):
+            y = M[j-1]
+            MtoL += A[y][z]
+            LtoM[j] += Az[y]
+            # K value if L is last
+            KL = Bi1[j] + inLi + MtoL
+            # K value if M is last
+            KM = Bi[j-1] + LtoM[j] + inM[j]
+            # maximize
+            if KL > KM:
+                Bi[j] = KL
+                Ci[j] = 'L'
+            else:
+                Bi[j] = KM
+                Ci[j] = 'M'
+    # return answer -- backtrack through B,C matrices
+    N = [ ]              # accumulate in reverse order
+    i = nL
+    j = nM
+    while i>0 or j>0:
+        if C[i][j] == 'L':
+            N.append(L[i-1])
+            i = i-1
+        elif C[i][j] == 'M':
+            N.append(M[j-1])
+            j = j-1
+    N.reverse()
+    return N, B[nL][nM]
+
+def merge_cubic(A, L, M):
+    """
+    A is an input matrix of size m x m
+    L and M are disjoint subsets of range(m)
+    Return the merge N of L and M with maximum K value.
+
+    This is the original O(m^3) version of merge, in which each entry
+    of the dynamic-programming matrix rescans L and M.  (Not used any
+    more, but kept for reference and for testing merge.)
     """
     m = len(A)
     nL = len(L)
@@ -347,6 +529,18 @@ def test_merge():
                 assert KNN <= KN
             # print NN, KNN
 
+def test_merge_cubic():
+    """ Test that merge agrees with merge_cubic, ties included. """
+    for test_type in (1, 2):
+        A = test_A(30, test_type)
+        for k in range(1, 30, 7):
+            L = range(0, 30, 2)[:k] + range(1, 30, 3)
+            M = [x for x in range(30) if x not in L]
+            assert merge(A, L, M) == merge_cubic(A, L, M)
+            assert merge(A, M, L) == merge_cubic(A, M, L)
+
+test_merge_cubic()
+
 def random_split(L, nM=None):
     """
     Split sequence L into two random subsequences M, N
@@ -394,10 +588,306 @@ def split_merge(A, L, steps=100, nM=None):
         # print L, KL
     return L, KL
 
-def dc(A, L=None):
+##############################################################################
+## local search: adjacent swaps and insertions, with incremental K changes
+##############################################################################
+
+def swap_delta(A, L, i):
+    """ Return change in K(A, L) from swapping L[i] and L[i+1]. O(1) time. """
+    return A[L[i+1]][L[i]] - A[L[i]][L[i+1]]
+
+def insertion_deltas(A, L, i):
+    """
+    Return list D with D[j] the change in K(A, L) from moving L[i]
+    to position j (shifting the elements in between by one).  O(m) time:
+    moving z = L[i] past y changes K by A[z][y]-A[y][z] (forward)
+    or A[y][z]-A[z][y] (backward).
+    """
+    z = L[i]
+    Az = A[z]
+    D = [0 for j in range(len(L))]
+    d = 0
+    for j in range(i-1, -1, -1):
+        y = L[j]
+        d += Az[y] - A[y][z]
+        D[j] = d
+    d = 0
+    for j in range(i+1, len(L)):
+        y = L[j]
+        d += A[y][z] - Az[y]
+        D[j] = d
+    return D
+
+def move(L, i, j):
+    """ Move L[i] to position j, in place. """
+    L.insert(j, L.pop(i))
+
+def best_insertion(A, L, out_of_time=None):
+    """
+    Return (d, i, j) for the best move of L[i] to another position j
+    (d is the change in K(A, L)), over all i and j; an adjacent swap is
+    the move of a student by one position.  O(m^2) time.  Stops early
+    (with the best move so far) if out_of_time() becomes true.
+    """
+    m = len(L)
+    best = (0, 0, 0)
+    for i in range(m):
+        if out_of_time != None and out_of_time():
+            break
+        D = insertion_deltas(A, L, i)
+        j = max(range(m), key=D.__getitem__)
+        if D[j] > best[0]:
+            best = (D[j], i, j)
+    return best
+
+def local_search(A, L, strategy="first", seconds=None, KL=None):
+    """
+    Improve order L (a list, not changed) by local search, until no
+    move improves K(A, L) or the time budget (in seconds, if given)
+    runs out.  Moves are insertions of a student at another position
+    (found at O(m) for all positions of a student), including adjacent
+    swaps (at O(1) each).  strategy is
+        "first" -- make each improving move as soon as it is found:
+                   passes of adjacent swaps until none improves, then a
+                   pass moving each student to his best position
+        "best"  -- make the single best move (by best_insertion) over
+                   all students and positions each time
+    Only improving moves are made, so the current order is always the
+    best found.  KL is K(A, L), if already known.
+    Return best order, its K value, and the K trajectory: a list of
+    (seconds elapsed, K value) pairs, one for the start and one after
+    each pass that improved K (for "best", after each move).
+    """
+    if strategy not in ("first", "best"):
+        raise ValueError("unknown local search strategy: " + str(strategy))
+    t0 = time.time()
+    def out_of_time():
+        return seconds != None and time.time()-t0 >= seconds
+    L = list(L)
+    m = len(L)
+    if KL == None:
+        KL = K(A, L)
+    trajectory = [(0.0, KL)]
+    improved = True
+    while improved and not out_of_time():
+        improved = False
+        if strategy == "best":
+            d, i, j = best_insertion(A, L, out_of_time)
+            if d > 0:
+                move(L, i, j)
+                KL += d
+                improved = True
+        else:
+            # adjacent swaps, until none improves
+            swapped = True
+            while swapped and not out_of_time():
+                swapped = False
+                for i in range(m-1):
+                    d = swap_delta(A, L, i)
+                    if d > 0:
+                        L[i], L[i+1] = L[i+1], L[i]
+                        KL += d
+                        swapped = improved = True
+            # insertions, each student to his best position
+            for i in range(m):
+                if out_of_time():
+                    break
+                D = insertion_deltas(A, L, i)
+                j = max(range(m), key=D.__getitem__)
+                if D[j] > 0:
+                    move(L, i, j)
+                    KL += D[j]
+                    improved = True
+        if improved:
+            trajectory.append((time.time()-t0, KL))
+    return L, KL, trajectory
+
+def test_local_search():
+    """
+    Test that local search improves K correctly, never past optimum;
+    that "best" makes the best move each time (checked for the first
+    move, against trying all moves), and that it differs from "first"
+    """
+    differ = False
+    for m in range(2, 9):
+        A = test_A(m, 2)
+        L = range(m-1, -1, -1)
+        best_K = SDP(A, L)[1]
+        results = dict()
+        for strategy in ("first", "best"):
+            LS, KLS, trajectory = local_search(A, L, strategy)
+            assert sorted(LS) == sorted(L)
+            assert KLS == K(A, LS) <= best_K
+            assert KLS >= K(A, L)
+            Ks = [Kt for (t, Kt) in trajectory]
+            assert Ks == sorted(Ks)
+            results[strategy] = Ks
+        best_first_K = K(A, L)
+        for i in range(m):
+            for j in range(m):
+                L2 = list(L)
+                move(L2, i, j)
+                best_first_K = max(best_first_K, K(A, L2))
+        assert results["best"][min(1, len(results["best"])-1)] == best_first_K
+        differ = differ or results["best"] != results["first"]
+    assert differ
+
+test_local_search()
+
+##############################################################################
+## parallel multi-start search: split-merge chains in worker processes
+##############################################################################
+
+def shared_matrix(A):
+    """
+    Return copy of m x m matrix A in shared memory (a flat RawArray of
+    doubles), which worker processes can read without copying it.
+    """
+    m = len(A)
+    shared = multiprocessing.sharedctypes.RawArray('d', m*m)
+    for i in range(m):
+        shared[i*m:(i+1)*m] = [float(a) for a in A[i]]
+    return shared
+
+def matrix_view(shared, m):
+    """ Return m x m view A[i][j] of shared matrix (from shared_matrix). """
+    return (ctypes.c_double * m * m).from_buffer(shared)
+
+def chain_seed(seed, chain, rnd):
+    """ Return random number seed for given chain and round. """
+    return (seed * 1000003 + rnd) * 1009 + chain
+
+def run_chain(A, L, KL, seed, chain, rnd, steps, polish):
+    """
+    Run one round of one chain: (if polish) local search, then
+    split-merge for the given number of steps, with the random number
+    generator seeded from (seed, chain, rnd).  Return best order found
+    and its K value.
+    """
+    random.seed(chain_seed(seed, chain, rnd))
+    if polish:
+        L, KL, trajectory = local_search(A, L, "first", None, KL)
+    best_L, best_K = L, KL
+    for _ in range(steps):
+        L, KL = split_merge(A, L, 1)
+        if KL > best_K:
+            best_L, best_K = L, KL
+    return best_L, best_K
+
+_A = None
+
+def _init_worker(shared, m):
+    """ Initializer for worker processes: view of shared matrix. """
+    global _A
+    _A = matrix_view(shared, m)
+
+def _chain_worker(args):
+    """ Worker running one round of one chain on the shared matrix. """
+    return run_chain(_A, *args)
+
+def perturb(L, rng, swaps=None):
+    """
+    Return copy of order L with some random adjacent swaps (by default
+    len(L)//10 + 1), made with random number generator rng.
+    """
+    L = list(L)
+    if swaps == None:
+        swaps = len(L)//10 + 1
+    for _ in range(swaps):
+        if len(L) > 1:
+            i = rng.randrange(len(L)-1)
+            L[i], L[i+1] = L[i+1], L[i]
+    return L
+
+def parallel_search(A, starts, jobs=1, seed=1, seconds=None, rounds=None,
+                    steps=100, progress=None, chains=None):
+    """
+    Optimize K(A, L) by multi-start split-merge search, with 'chains'
+    chains (default: jobs).  Chain c starts from starts[c % len(starts)]
+    (e.g. the dc order, a Borda order and a reversed order), randomly
+    perturbed (see perturb) once every start has been used.  The chains
+    run in rounds of the given number of split-merge steps (the first
+    round starting with a local search).  After each round the chains
+    exchange orders: the worse half of them continue from the best
+    order found so far, and the others from their own; each chain has
+    its own random number seed.  The chains of a round are run by
+    'jobs' worker processes (sharing A read-only, see shared_matrix),
+    or in this process if jobs is 1.
+
+    Rounds are run until 'rounds' rounds are done, or, if rounds is
+    None, until time budget 'seconds' runs out (at the end of a round).
+    All seeds depend only on seed, the chain and the round (see
+    chain_seed), so the result depends only on A, starts, seed, steps,
+    the number of chains and the number of rounds run -- not on jobs
+    (once chains is fixed) or timing.
+    If given, progress(rnd, K) is called after each round that improves K.
+    Return best order, its K value, and the number of rounds run.
+    """
+    if chains == None:
+        chains = jobs
+    orders = []
+    for c in range(chains):
+        L = list(starts[c % len(starts)])
+        if c >= len(starts):
+            L = perturb(L, random.Random(chain_seed(seed, c, -1)))
+        orders.append(L)
+    Ks = [K(A, L) for L in orders]
+    best = max(range(chains), key=lambda c: (Ks[c], -c))
+    best_L, best_K = orders[best], Ks[best]
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker,
+                                    (shared_matrix(A), len(A)))
+    t0 = time.time()
+    rnd = 0
+    try:
+        while (rounds == None and (seconds == None or time.time()-t0 < seconds)) \
+              or (rounds != None and rnd < rounds):
+            tasks = [(orders[c], Ks[c], seed, c, rnd, steps, rnd == 0)
+                     for c in range(chains)]
+            if pool != None:
+                results = pool.map(_chain_worker, tasks)
+            else:
+                results = [run_chain(A, *task) for task in tasks]
+            rnd += 1
+            orders = [L for (L, KL) in results]
+            Ks = [KL for (L, KL) in results]
+            best = max(range(chains), key=lambda c: (Ks[c], -c))
+            if Ks[best] > best_K:
+                best_L, best_K = results[best]
+                if progress != None:
+                    progress(rnd, best_K)
+            # exchange: the worse half of the chains continue from the best order
+            ranked = sorted(range(chains), key=lambda c: (Ks[c], -c))
+            for c in ranked[:chains//2]:
+                orders[c], Ks[c] = best_L, best_K
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+    return best_L, best_K, rnd
+
+def test_parallel_search():
+    """ Test that parallel_search is reproducible and never worsens K """
+    A = test_A(12, 2)
+    starts = [range(12), range(11, -1, -1)]
+    L1, K1, r1 = parallel_search(A, starts, 1, seed=3, rounds=2, steps=5,
+                                 chains=4)
+    L2, K2, r2 = parallel_search(A, starts, 1, seed=3, rounds=2, steps=5,
+                                 chains=4)
+    assert (L1, K1, r1) == (L2, K2, 2)
+    assert K(A, L1) == K1 >= max(K(A, L) for L in starts)
+
+test_parallel_search()
+
+DC_BASE = 12          # largest lists solved exactly by dc
+
+def dc(A, L=None, base=None):
     """ 
     Use divide-and-conquer approach to approximately 
     optimize K(A, L); split-merge is used as a subroutine.
+    Lists of at most base (default DC_BASE) elements are
+    solved exactly, by SDP.
 
     This method can get a very good initial approximation
     quickly; further optimization can be obtained using
@@ -406,12 +896,14 @@ def dc(A, L=None):
     m = len(A)
     if L == None:
         L = range(m)
-    if len(L)<7:
-        return BF(A, L)
+    if base == None:
+        base = DC_BASE
+    if len(L) <= base:
+        return SDP(A, L)
     nL = len(L)
     nLmid = int(len(L)/2)
-    L1, KL1 = dc(A, L[:nLmid])
-    L2, KL2 = dc(A, L[nLmid:])
+    L1, KL1 = dc(A, L[:nLmid], base)
+    L2, KL2 = dc(A, L[nLmid:], base)
     L, KL = merge(A, L1, L2)
     return split_merge(A, L, 1)
 
@@ -0,0 +1,402 @@
+# outofcore.py
+# out-of-core version of student ranking program (rank.py)
+# python3
+
+"""
+Rank a class too large to hold in memory:
+
+    python3 outofcore.py huge.csv --memory-mb 256
+
+The input is the usual CSV file (see rank.parse_csv), and the output
+is the same three .rank.csv files as rank.py writes (without the
+terminal listings), with the same rows in the same order: scores and
+ranks follow rank.py and policy.py exactly.  Memory use is kept to
+about the given budget, whatever the number of students, by streaming
+through the file twice and sorting on disk:
+
+    pass 1  count the students having each distinct grade in each
+            weighted column (a histogram), from which every student's
+            beats count follows: the number of strictly lower grades,
+            plus one half for each other equal grade, plus one.  A
+            column with too many distinct grades for its share of the
+            budget is instead written to disk in sorted runs, which are
+            merged into a file of its distinct grades and their beats,
+            looked up by binary search.
+
+    pass 2  for each chunk of rows: convert grades, compute scores,
+            drop scores (policy.apply_drop_plan) and weighted scores
+            (policy.compute_wtd_scores); format each row of each output
+            table, and write the chunk's rows for each table, sorted
+            by weighted score, as a run file.
+
+    merge   merge the runs of each table (an external merge sort, with
+            ties broken by student number, as in rank.sort_state),
+            numbering the ranks as the rows are written.
+
+Temporary files go in a temporary directory (--tmpdir), removed after.
+"""
+
+import argparse
+import array
+import bisect
+import csv
+import heapq
+import itertools
+import mmap
+import os
+import shutil
+import tempfile
+
+import policy
+import rank
+
+MISSING = "--"
+def ismissing(x):
+    """ Return True if x is MISSING. """
+    return x == MISSING
+
+BYTES_PER_CELL = 200         # rough memory per cell of a chunk, all told
+BYTES_PER_DISTINCT = 150     # rough memory per entry of a histogram
+MAX_FAN_IN = 200             # most run files merged at once
+MIN_CHUNK_ROWS = 1000        # fewest rows per chunk, whatever the budget
+MIN_DISTINCT = 1000          # fewest distinct grades counted in memory
+
+OUTPUT_SUFFIXES = [".1.grades.rank.csv",
+                   ".2.scores.rank.csv",
+                   ".3.droppedscores.rank.csv"]
+
+def read_rows(input_filename, skiprows=0):
+    """
+    Return names, perfect_grades and weights (as from rank.parse_header)
+    and an iterator over the grade rows of CSV file input_filename.
+    The file stays open until the iterator is exhausted.
+    """
+    csvfile = open(input_filename, newline='')
+    reader = csv.reader(csvfile)
+    for _ in range(skiprows):
+        next(reader)
+    names, perfect_grades, weights = \
+        rank.parse_header(next(reader), next(reader), next(reader))
+    def rows():
+        with csvfile:
+            for row in reader:
+                assert len(row) == len(names)
+                yield row
+    return names, perfect_grades, weights, rows()
+
+def chunks(rows, chunk_rows):
+    """ Generate lists of (at most) chunk_rows rows. """
+    while True:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if not chunk:
+            return
+        yield chunk
+
+##############################################################################
+## Beats counts for a column: histogram, or sorted runs on disk
+##############################################################################
+
+class ColumnBeats():
+    """
+    Beats counts for one weighted column, built from its grades in
+    pass 1 (add), then looked up in pass 2 (beats).
+    While the column has at most max_distinct distinct grades, they
+    are counted in a dict; beyond that, all its grades are written to
+    disk in sorted runs, merged by finish into a file of distinct
+    grades and a file of their beats counts.
+    """
+    def __init__(self, tmpdir, max_distinct):
+        self.tmpdir = tmpdir
+        self.max_distinct = max_distinct
+        self.counts = dict()
+        self.n = 0                  # students with data (incl. NaN)
+        self.runs = None            # run files, once spilled
+        self.beats_of = None        # dict grade -> beats, or
+        self.values = None          # sorted distinct grades (on disk)
+        self.value_beats = None     # and their beats (on disk)
+
+    def add(self, values):
+        """ Count the (converted) grades in values. """
+        if self.runs is None:
+            counts = self.counts
+            for d in values:
+                if not ismissing(d):
+                    self.n += 1
+                    if d == d:
+                        counts[d] = counts.get(d, 0) + 1
+            if len(counts) > self.max_distinct:
+                self.runs = []
+                self._spill(itertools.chain.from_iterable(
+                    itertools.repeat(d, c) for d, c in counts.items()))
+                self.counts = None
+        else:
+            present = [d for d in values if not ismissing(d)]
+            self.n += len(present)
+            self._spill(d for d in present if d == d)
+
+    def _spill(self, grades):
+        """ Write grades, sorted, as a new run file. """
+        run = array.array('d', grades)
+        run = array.array('d', sorted(run))
+        file_name = os.path.join(self.tmpdir,
+                                 "beats%d_%d.run" % (id(self), len(self.runs)))
+        with open(file_name, "wb") as file:
+            run.tofile(file)
+        self.runs.append(file_name)
+
+    def finish(self):
+        """ Work out the beats count of each distinct grade. """
+        if self.runs is None:
+            self.beats_of = dict()
+            below = 0
+            for d in sorted(self.counts):
+                count = self.counts[d]
+                self.beats_of[d] = below + 0.5*(count-1) + 1.0
+                below += count
+            self.counts = None
+            return
+        merged = merge_sorted_files(self.runs, self.tmpdir)
+        base = os.path.join(self.tmpdir, "beats%d" % id(self))
+        below = 0
+        with open(base + ".values", "wb") as vfile, \
+             open(base + ".beats", "wb") as bfile:
+            for d, group in itertools.groupby(merged):
+                count = sum(1 for _ in group)
+                array.array('d', [d]).tofile(vfile)
+                array.array('d', [below + 0.5*(count-1) + 1.0]).tofile(bfile)
+                below += count
+        for file_name in self.runs:
+            os.remove(file_name)
+        self.values = _map_floats(base + ".values")
+        self.value_beats = _map_floats(base + ".beats")
+
+    def beats(self, d):
+        """ Return beats count of a student with (converted) grade d. """
+        if ismissing(d):
+            return 0
+        if d != d:
+            # NaN is equal to and greater than nothing, so it only beats itself
+            return 1.0
+        if self.beats_of is not None:
+            return self.beats_of[d]
+        return self.value_beats[bisect.bisect_left(self.values, d)]
+
+def _map_floats(file_name):
+    """ Return memory-mapped file of doubles, as a sequence of floats. """
+    if os.path.getsize(file_name) == 0:
+        return []
+    with open(file_name, "rb") as file:
+        return memoryview(mmap.mmap(file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)).cast('d')
+
+def _read_floats(file_name, block=1<<16):
+    """ Generate the doubles in file_name, reading a block at a time. """
+    with open(file_name, "rb") as file:
+        while True:
+            values = array.array('d')
+            values.frombytes(file.read(8*block))
+            if not values:
+                return
+            yield from values
+
+def merge_sorted_files(file_names, tmpdir):
+    """
+    Generate, in increasing order, the doubles in the given files of
+    sorted doubles.  At most MAX_FAN_IN files are merged at once: any
+    more are first merged into bigger files, replacing them in the list
+    file_names.
+    """
+    while len(file_names) > MAX_FAN_IN:
+        group = file_names[:MAX_FAN_IN]
+        del file_names[:MAX_FAN_IN]
+        merged_name = group[0] + ".m"
+        with open(merged_name, "wb") as file:
+            for block in _blocks(heapq.merge(*[_read_floats(name)
+                                               for name in group])):
+                block.tofile(file)
+        for name in group:
+            os.remove(name)
+        file_names.append(merged_name)
+    return heapq.merge(*[_read_floats(name) for name in file_names])
+
+def _blocks(values, block=1<<16):
+    """ Generate arrays of (at most) block values from values. """
+    while True:
+        values_block = array.array('d', itertools.islice(values, block))
+        if not values_block:
+            return
+        yield values_block
+
+##############################################################################
+## Output tables: sorted runs of formatted rows, then merged
+##############################################################################
+
+def write_run(records, file_name):
+    """
+    Write records (wtd_score, stu, line), in decreasing order of
+    (wtd_score, stu), to run file file_name, one per line.
+    """
+    records.sort(reverse=True)
+    with open(file_name, "w") as file:
+        for ws, stu, line in records:
+            file.write("%r\t%d\t%s\n" % (ws, stu, line))
+
+def read_run(file_name):
+    """ Generate records (wtd_score, stu, line) of run file file_name. """
+    with open(file_name) as file:
+        for text in file:
+            ws, stu, line = text.rstrip("\n").split("\t", 2)
+            yield float(ws), int(stu), line
+
+def merge_runs(run_names, tmpdir):
+    """
+    Generate records of the given runs in decreasing order of
+    (wtd_score, stu).  At most MAX_FAN_IN runs are merged at once: any
+    more are first merged into bigger runs, replacing them in the list
+    run_names.
+    """
+    while len(run_names) > MAX_FAN_IN:
+        group = run_names[:MAX_FAN_IN]
+        del run_names[:MAX_FAN_IN]
+        merged_name = group[0] + ".m"
+        with open(merged_name, "w") as file:
+            for ws, stu, line in heapq.merge(*[read_run(name)
+                                               for name in group],
+                                             reverse=True):
+                file.write("%r\t%d\t%s\n" % (ws, stu, line))
+        for name in group:
+            os.remove(name)
+        run_names.append(merged_name)
+    return heapq.merge(*[read_run(name) for name in run_names], reverse=True)
+
+def write_table(file_name, names, records):
+    """
+    Write output table (as rank.write_output would for the state sorted
+    by rank.rank_by) from records in decreasing order of (wtd_score, stu).
+    """
+    with open(file_name, "w", buffering=1<<16) as file:
+        file.write("".join([str(name.strip()) + ", "
+                            for name in names + ["wtd_score", "rank"]]))
+        file.write("\n")
+        for r, (ws, stu, line) in enumerate(records):
+            file.write("%s%s, %d, \n" % (line, rank.datum_text(ws), r + 1))
+
+##############################################################################
+## Ranking
+##############################################################################
+
+def rank_out_of_core(input_filename, skiprows=0, memory_bytes=256*1024*1024,
+                     policy=policy, tmpdir=None, output_prefix=None):
+    """
+    Rank the students in CSV file input_filename following policy (as
+    for rank.rank_pipeline), using about memory_bytes of memory, and
+    write the .rank.csv files (to output_prefix + suffix; by default
+    output_prefix is input_filename).  Return the number of students.
+    """
+    if output_prefix is None:
+        output_prefix = input_filename
+    workdir = tempfile.mkdtemp(prefix="rank-", dir=tmpdir)
+    try:
+        return _rank(input_filename, skiprows, memory_bytes, policy,
+                     workdir, output_prefix)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def _rank(input_filename, skiprows, memory_bytes, policy, workdir,
+          output_prefix):
+    names, perfect_grades, weights, rows = read_rows(input_filename,
+                                                     skiprows)
+    n_col = len(names)
+    weighted = [col for col in range(n_col) if weights[col] > 0]
+    chunk_rows = max(MIN_CHUNK_ROWS,
+                     memory_bytes // (BYTES_PER_CELL * (n_col + 2)))
+    max_distinct = max(MIN_DISTINCT, memory_bytes //
+                       (2 * BYTES_PER_DISTINCT * max(1, len(weighted))))
+
+    # pass 1: beats counts of each weighted column
+    memos = {col: dict() for col in weighted}
+    col_beats = {col: ColumnBeats(workdir, max_distinct) for col in weighted}
+    n_stu = 0
+    for chunk in chunks(rows, chunk_rows):
+        n_stu += len(chunk)
+        for col in weighted:
+            col_beats[col].add(rank.convert_column([row[col] for row in chunk],
+                                                   memos[col]))
+    for col in weighted:
+        col_beats[col].finish()
+
+    # pass 2: scores, drops and weighted scores, a chunk at a time
+    rank_weight = policy.RANK_WEIGHT
+    drop = policy.DROP_POLICY != []
+    plan = policy.compile_drop_policy(names, policy.DROP_POLICY)
+    n_tables = 3 if drop else 2
+    run_names = [[] for table in range(n_tables)]
+    names, perfect_grades, weights, rows = read_rows(input_filename,
+                                                     skiprows)
+    first_stu = 0
+    for chunk in chunks(rows, chunk_rows):
+        cols = [[row[col] for row in chunk] for col in range(n_col)]
+        for col in weighted:
+            cols[col] = rank.convert_column(cols[col], memos[col])
+        grade_state = rank.CowState.from_columns(names, perfect_grades,
+                                                 weights, cols)
+        score_cols = list(cols)
+        for col in weighted:
+            beats = col_beats[col].beats
+            n = col_beats[col].n
+            pg = perfect_grades[col]
+            # as in rank.normalize_scores
+            score_cols[col] = [
+                MISSING if ismissing(d)
+                else rank_weight*(beats(d) / (float(n) + 1.0))
+                     + (1-rank_weight)*(d / pg)
+                for d in cols[col]]
+        score_state = rank.CowState.from_columns(names, perfect_grades,
+                                                 weights, score_cols)
+        wtd_score = policy.compute_wtd_scores(score_state)
+        tables = [(grade_state, wtd_score), (score_state, wtd_score)]
+        if drop:
+            dropped_state = policy.apply_drop_plan(score_state, plan)
+            tables.append((dropped_state,
+                           policy.compute_wtd_scores(dropped_state)))
+        for table, (state, ws) in enumerate(tables):
+            records = [(w, first_stu + stu, "".join([cell + ", "
+                                                     for cell in cells]))
+                       for stu, (w, cells)
+                       in enumerate(zip(ws, rank.output_rows(state)))]
+            run_name = os.path.join(workdir, "table%d_%d.run"
+                                    % (table, len(run_names[table])))
+            write_run(records, run_name)
+            run_names[table].append(run_name)
+        first_stu += len(chunk)
+
+    # merge: write each table in rank order
+    for table in range(n_tables):
+        write_table(output_prefix + OUTPUT_SUFFIXES[table], names,
+                    merge_runs(run_names[table], workdir))
+        print(output_prefix + OUTPUT_SUFFIXES[table], "written.")
+    return n_stu
+
+def main():
+    """ Main routine. """
+    parser = argparse.ArgumentParser(\
+                description='Rank-order students, out of core.')
+    parser.add_argument('input_filename',
+                        help='csv file, in the format read by rank.py')
+    parser.add_argument('--skiprows', default=0,
+                        help='number of rows to skip before header row')
+    parser.add_argument('--memory-mb', default=256,
+                        help='memory budget, in MB')
+    parser.add_argument('--tmpdir',
+                        help='directory for temporary files '\
+                        '(default: system temporary directory)')
+    args = parser.parse_args()
+
+    print("Reading input file:", args.input_filename)
+    n_stu = rank_out_of_core(args.input_filename, int(args.skiprows),
+                             int(float(args.memory_mb)*1024*1024),
+                             policy, args.tmpdir)
+    print(n_stu, "students")
+
+if __name__ == "__main__":
+    main()
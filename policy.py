@@ -22,6 +22,12 @@ RANK_WEIGHT = 0.5    # Average scaled rank and scaled grades.
 
 ##############################################################################
 
+import operator
+try:
+    import numpy as np          # optional: faster drops for long items
+except ImportError:
+    np = None
+
 MISSING = "--"
 def ismissing(x):
     """ Return True if x is MISSING. """
@@ -38,22 +44,22 @@ def isnonnumeric(x):
 def compute_wtd_scores(state):
     """  Compute weighted average scores. """
     wtd_score = [0 for stu in state.students]
-    for stu in state.students:
-        total = 0.0
-        total_weight = 0.0
-        for col in state.columns:
-            if state.weights[col] > 0:
-                d = state.data[stu][col]
+    total = [0.0 for stu in state.students]
+    total_weight = [0.0 for stu in state.students]
+    for col in state.columns:
+        if state.weights[col] > 0:
+            for stu, d in enumerate(state.column(col)):
                 if not ismissing(d):
-                    total += state.weights[col] * d
-                    total_weight += state.weights[col]
-        if total_weight > 0:
-            wtd_score[stu] = total / total_weight
+                    total[stu] += state.weights[col] * d
+                    total_weight[stu] += state.weights[col]
+    for stu in state.students:
+        if total_weight[stu] > 0:
+            wtd_score[stu] = total[stu] / total_weight[stu]
         else:
             wtd_score[stu] = 0.0
     return wtd_score
 
-def drop(state, drop_policy=DROP_POLICY):
+def drop(state, drop_policy=DROP_POLICY, verbose=True, plan=None):
     """
     Drop some of the student scores and
     return resulting modified scores.
@@ -63,24 +69,136 @@ def drop(state, drop_policy=DROP_POLICY):
           (1, "Q1", "Q2")                    # drop lowest quiz
         ]
     Note that here "lowest" is intended to refer to scores, not grades.
+    The drop policy is printed first, if verbose.
+
+    The drop policy is first compiled (see compile_drop_policy), unless
+    an already compiled plan for it is given, and then applied to all
+    students at once, column by column.  The result is the same as that
+    of applying process_drop_policy_item to each student's row.
+    """
+    if verbose:
+        print_drop_policy(state.names, drop_policy)
+    if plan is None:
+        plan = compile_drop_policy(state.names, drop_policy)
+    return apply_drop_plan(state, plan)
+
+class DropPlan():
+    """
+    Drop policy compiled for a given list of column names, consisting of:
+        names       the column names
+        active      True if the drop policy has any items at all
+        items       list of (k, cols) pairs, one per drop policy item
+                    having columns in names; cols lists those columns,
+                    in drop policy order
+        duplicates  list of (col, last_col) pairs, for each column
+                    whose name is repeated in a later column last_col
     """
-    print_drop_policy(state.names, drop_policy)
-    new_scores = []
-    for score_row in state.data:
-        for drop_policy_item in drop_policy:
-            score_row = process_drop_policy_item(state.names,
-                                                 score_row,
-                                                 drop_policy_item)
-        new_scores.append(score_row)
+    def __init__(self, names, active, items, duplicates):
+        self.names = list(names)
+        self.active = active
+        self.items = items
+        self.duplicates = duplicates
+
+def compile_drop_policy(names, drop_policy=DROP_POLICY):
+    """
+    Return DropPlan for applying drop_policy to states with given names.
+    The plan may be reused for any number of states with those names.
+
+    Like process_drop_policy_item, which looks names up in a dict,
+    a name used for several columns refers to the last of them, and
+    the others end up as copies of it.
+    """
+    last_col = dict()
+    for col, name in enumerate(names):
+        last_col[name] = col
+    items = []
+    for drop_policy_item in drop_policy:
+        k = drop_policy_item[0]
+        drop_policy_names = drop_policy_item[1:]
+        cols = [last_col[name] for name in drop_policy_names if name in last_col]
+        if cols:
+            items.append((k, cols))
+    duplicates = [(col, last_col[name]) for col, name in enumerate(names)
+                  if last_col[name] != col]
+    return DropPlan(names, len(drop_policy) > 0, items, duplicates)
+
+INF = float("inf")
+
+def apply_drop_plan(state, plan):
+    """
+    Return copy of state with scores dropped according to compiled plan.
+    MISSING scores count as lowest (as -1), and NaN scores as highest;
+    the k lowest scores of each item are found column by column for all
+    students at once (see lowest_k), with ties dropped in drop policy
+    order, as by a stable sort of each student's scores for the item.
+    """
+    assert list(state.names) == plan.names
     new_state = state.copy()
-    new_state.data = new_scores
+    if not plan.active:
+        return new_state
+    changed = dict()
+    def column(col):
+        if col not in changed:
+            changed[col] = list(state.column(col))
+        return changed[col]
+
+    # scores of -1 are made MISSING, just as process_drop_policy_item does
+    for col in state.columns:
+        if -1 in state.column(col):
+            changed[col] = [MISSING if d == -1 else d
+                            for d in state.column(col)]
+
+    for k, cols in plan.items:
+        values = [column(col) for col in cols]
+        keys = [[-1 if d == MISSING else d if d == d else INF for d in v]
+                for v in values]
+        for v, dropped in zip(values, lowest_k(keys, k)):
+            v[:] = [MISSING if drop else d for d, drop in zip(v, dropped)]
+
+    for col, last in plan.duplicates:
+        changed[col] = list(column(last))
+    for col, values in changed.items():
+        new_state.set_column(col, values)
     return new_state
 
+def lowest_k(keys, k):
+    """
+    Given keys, a list of c columns of numbers (one per student each),
+    return c columns of flags, true where the key is among the k lowest
+    of the student's c keys (ties going to the earlier column).  Keys
+    may also be text, from zero-weight columns, which are not scored.
+
+    With numpy and numeric keys this is a stable argsort of the
+    c x n_stu matrix of keys (as in columnar.drop).  Otherwise, the key
+    in column p is among the k lowest if fewer than k keys come before
+    it (are lower, or equal and in an earlier column), which is counted
+    by comparing the columns pairwise, a whole column at a time.
+    """
+    if np is not None:
+        matrix = np.array(keys)
+        if matrix.dtype.kind in "iuf":
+            lowest = np.argsort(matrix, axis=0, kind='stable')[:k]
+            flags = np.zeros(matrix.shape, dtype=bool)
+            np.put_along_axis(flags, lowest, True, axis=0)
+            return flags.tolist()
+    flags = []
+    for p, key_p in enumerate(keys):
+        before = [0] * len(key_p)
+        for q, key_q in enumerate(keys):
+            if q != p:
+                precedes = operator.le if q < p else operator.lt
+                before = list(map(operator.add, before,
+                                  map(precedes, key_q, key_p)))
+        flags.append(list(map(k.__gt__, before)))
+    return flags
+
 def process_drop_policy_item(names, score_row, drop_policy_item):
     """
     Return score_row after effecting given drop_policy item.
     Here drop_policy_item is, e.g. (1, "Q1", "Q2") (E.g. drop lowest quiz.)
     Dropping is effected by replacing values by MISSING in score_row
+    (This is the one-row version of drop, kept as the reference for it;
+    drop itself uses a DropPlan.)
     """
     k = drop_policy_item[0]
     drop_policy_names = drop_policy_item[1:]
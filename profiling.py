@@ -0,0 +1,136 @@
+# profiling.py
+""" per-stage timing and memory instrumentation for rank.py """
+# used by student ranking program rank.py (with --profile)
+
+"""
+A Profiler records, for each stage of the ranking program (reading,
+scoring, dropping, sorting, output), its wall time, CPU time, memory
+allocated (using tracemalloc), and the number of rows and columns
+of its result.  Each record is also passed to any given callbacks
+(e.g. for a metrics exporter) as soon as the stage finishes.
+
+rank.py uses NO_PROFILER when profiling is off; its stages cost only
+a method call each.
+"""
+
+import contextlib
+import json
+import time
+import tracemalloc
+
+class StageRecord():
+    """ Measurements for one stage. """
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.alloc_bytes = None     # net change in traced memory
+        self.peak_bytes = None      # peak traced memory above start
+        self.n_stu = None
+        self.n_col = None
+
+    def set_counts(self, state):
+        """ Record number of rows (students) and columns of state. """
+        self.n_stu = state.n_stu
+        self.n_col = state.n_col
+
+    def as_dict(self):
+        """ Return record as a dict (e.g. for JSON output). """
+        return dict(vars(self))
+
+class Profiler():
+    """
+    Records a StageRecord for each stage, in order, in self.records.
+    Use as:
+        with profiler.stage("score") as stage:
+            score_state = compute_scores(grade_state)
+            stage.set_counts(score_state)
+    If trace_memory, tracemalloc is started (which slows the program
+    down noticeably) and allocations are recorded.
+    """
+    def __init__(self, callbacks=(), trace_memory=True):
+        self.callbacks = list(callbacks)
+        self.trace_memory = trace_memory
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager measuring one stage with given name. """
+        record = StageRecord(name)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_seconds = time.perf_counter() - wall0
+            record.cpu_seconds = time.process_time() - cpu0
+            if self.trace_memory:
+                current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+                record.alloc_bytes = current_bytes - start_bytes
+                record.peak_bytes = peak_bytes - start_bytes
+            self.records.append(record)
+            for callback in self.callbacks:
+                callback(record)
+
+    def report(self):
+        """ Return dict with all records, and total times. """
+        return {"stages": [record.as_dict() for record in self.records],
+                "total_wall_seconds":
+                    sum(record.wall_seconds for record in self.records),
+                "total_cpu_seconds":
+                    sum(record.cpu_seconds for record in self.records)}
+
+    def write_json(self, file_name):
+        """ Write report to file as JSON. """
+        with open(file_name, "w") as file:
+            json.dump(self.report(), file, indent=1)
+            file.write("\n")
+
+    def print_report(self):
+        """ Print report as a table. """
+        print("%-16s %10s %10s %12s %12s %9s %6s"
+              % ("stage", "wall (s)", "cpu (s)", "alloc (KB)", "peak (KB)",
+                 "rows", "cols"))
+        for record in self.records:
+            print("%-16s %10.4f %10.4f %12s %12s %9s %6s"
+                  % (record.name, record.wall_seconds, record.cpu_seconds,
+                     _kb(record.alloc_bytes), _kb(record.peak_bytes),
+                     _str(record.n_stu), _str(record.n_col)))
+
+def _kb(n_bytes):
+    """ Return n_bytes as KB string, or "-" if not measured. """
+    if n_bytes is None:
+        return "-"
+    return "%.1f" % (n_bytes / 1024.0)
+
+def _str(x):
+    """ Return x as string, or "-" if None. """
+    if x is None:
+        return "-"
+    return str(x)
+
+class _NullStage():
+    """ Stage of NullProfiler; does nothing. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_counts(self, state):
+        pass
+
+class NullProfiler():
+    """ Profiler that records nothing. """
+    records = []
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+_NULL_STAGE = _NullStage()
+NO_PROFILER = NullProfiler()
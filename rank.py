@@ -15,10 +15,28 @@ All class-specific policy code and data go into policy.py
 # Distributed under MIT License
 
 import argparse
+import array
+import concurrent.futures
 import copy
 import csv
+import heapq
+import itertools
+import os
+import sys
+from multiprocessing import shared_memory
 
 import policy
+import profiling
+import scorecache
+import sketch
+try:
+    import columnar             # optional NumPy backend (--columnar)
+except ImportError:
+    columnar = None
+try:
+    import gradebook            # binary gradebook files (needs numpy)
+except ImportError:
+    gradebook = None
 
 class State():
     """
@@ -49,6 +67,257 @@ class State():
         """ Return copy of this State object. """
         return State(self.names, self.perfect_grades, self.weights, self.data)
 
+    def column(self, col):
+        """ Return list of values in column col, one per student. """
+        return [row[col] for row in self.data]
+
+    def typed_column(self, col):
+        """
+        Return (converted) column col as a typed array of floats and a
+        missing mask, as by convert_column_typed.
+        """
+        return convert_column_typed(self.column(col))
+
+    def set_column(self, col, values):
+        """ Replace column col by values[stu] for each student. """
+        for stu in self.students:
+            self.data[stu][col] = values[stu]
+
+    def reorder(self, stu_order):
+        """ Put data rows into the given order (a permutation of students). """
+        self.data = [self.data[stu] for stu in stu_order]
+
+    def append_column(self, new_name, new_perfect_grade, new_weight, values):
+        """ Add new column at right, with values[stu] for each student. """
+        self.names.append(new_name)
+        self.perfect_grades.append(new_perfect_grade)
+        self.weights.append(new_weight)
+        self.n_col += 1
+        self.columns = list(range(self.n_col))
+        for stu in self.students:
+            self.data[stu].append(values[stu])
+
+class CowState():
+    """
+    Copy-on-write variant of State, with the same attributes and methods.
+
+    Grade data is held as a list of columns, and copies share their
+    columns; a column is copied only when it is first written to.
+    Reordering just records a permutation of the underlying rows,
+    and appending a column takes O(n_stu) time, so neither clones the
+    table.  state.data is a row-by-row view of the table, so code
+    written for State (e.g. in policy.py) also works on a CowState.
+    A column may be a TypedColumn (as read_grades makes for the
+    weighted columns), which is turned into a list when written to.
+    """
+    def __init__(self, names, perfect_grades, weights, data):
+        for row in data:
+            assert len(row) == len(names)
+        cols = [[row[col] for row in data] for col in range(len(names))]
+        self._init(names, perfect_grades, weights, cols, None)
+
+    @classmethod
+    def from_columns(cls, names, perfect_grades, weights, cols):
+        """ Return new CowState with given list of data columns. """
+        state = cls.__new__(cls)
+        state._init(names, perfect_grades, weights, cols, None)
+        state._owned = set(state.columns)
+        return state
+
+    def _init(self, names, perfect_grades, weights, cols, order):
+        """
+        Set up state from list cols of columns, each in the row order
+        given by order (or in order, if order is None).
+        """
+        self.names = copy.copy(names)
+        self.perfect_grades = copy.copy(perfect_grades)
+        self.weights = copy.copy(weights)
+        self._cols = cols
+        self._order = order
+        self._owned = set()         # columns not shared with other states
+
+        self.n_col = len(names)
+        self.columns = list(range(self.n_col))
+        if order is not None:
+            self.n_stu = len(order)
+        elif cols:
+            self.n_stu = len(cols[0])
+        else:
+            self.n_stu = 0
+        self.students = list(range(self.n_stu))
+
+        assert len(names) == len(perfect_grades)
+        assert len(names) == len(weights)
+        assert len(cols) == len(names)
+
+    def copy(self):
+        """ Return copy of this CowState object, sharing all columns. """
+        new_state = CowState.__new__(CowState)
+        new_state._init(self.names, self.perfect_grades, self.weights,
+                        list(self._cols), self._order)
+        self._owned = set()
+        return new_state
+
+    def _row_index(self, stu):
+        """ Return index into columns of data row for student stu. """
+        if self._order is None:
+            return stu
+        return self._order[stu]
+
+    def _writable(self, col):
+        """ Return column col, first copying it if it is shared. """
+        if col not in self._owned:
+            values = self._cols[col]
+            if isinstance(values, TypedColumn):
+                self._cols[col] = values.tolist()
+            else:
+                self._cols[col] = list(values)
+            self._owned.add(col)
+        return self._cols[col]
+
+    @property
+    def data(self):
+        """ Row-by-row view of the data table. """
+        return _CowRows(self)
+
+    @data.setter
+    def data(self, data):
+        cols = [[row[col] for row in data] for col in self.columns]
+        self._init(self.names, self.perfect_grades, self.weights, cols, None)
+        self._owned = set(self.columns)
+
+    def column(self, col):
+        """
+        Return list of values in column col, one per student.
+        (The list may be shared with other states; don't modify it.)
+        """
+        values = self._cols[col]
+        if isinstance(values, TypedColumn):
+            values = values.tolist()
+        if self._order is None:
+            return values
+        return list(map(values.__getitem__, self._order))
+
+    def typed_column(self, col):
+        """
+        Return (converted) column col as a typed array of floats and a
+        missing mask, as by convert_column_typed; a TypedColumn in row
+        order is returned without copying (don't modify it).
+        """
+        values = self._cols[col]
+        if isinstance(values, TypedColumn) and self._order is None:
+            return values.floats, values.missing
+        return convert_column_typed(self.column(col))
+
+    def _unordered(self, values):
+        """ Return values[stu] for each student, in underlying row order. """
+        if self._order is None:
+            return list(values)
+        new_col = [None] * self.n_stu
+        for stu, i in enumerate(self._order):
+            new_col[i] = values[stu]
+        return new_col
+
+    def set_column(self, col, values):
+        """ Replace column col by values[stu] for each student. """
+        self._cols[col] = self._unordered(values)
+        self._owned.add(col)
+
+    def reorder(self, stu_order):
+        """ Put data rows into the given order (a permutation of students). """
+        if self._order is None:
+            self._order = list(stu_order)
+        else:
+            self._order = list(map(self._order.__getitem__, stu_order))
+
+    def append_column(self, new_name, new_perfect_grade, new_weight, values):
+        """ Add new column at right, with values[stu] for each student. """
+        self.names.append(new_name)
+        self.perfect_grades.append(new_perfect_grade)
+        self.weights.append(new_weight)
+        self._cols.append(self._unordered(values))
+        self._owned.add(self.n_col)
+        self.n_col += 1
+        self.columns = list(range(self.n_col))
+
+class _CowRows():
+    """ Sequence of data rows of a CowState (see CowState.data). """
+    def __init__(self, state):
+        self._state = state
+
+    def __len__(self):
+        return self._state.n_stu
+
+    def __getitem__(self, stu):
+        return _CowRow(self._state, self._state._row_index(stu))
+
+    def __iter__(self):
+        for stu in self._state.students:
+            yield self[stu]
+
+class _CowRow():
+    """ One data row of a CowState; writes go through copy-on-write. """
+    __slots__ = ('_state', '_index')
+
+    def __init__(self, state, index):
+        self._state = state
+        self._index = index
+
+    def __len__(self):
+        return self._state.n_col
+
+    def __getitem__(self, col):
+        return self._state._cols[col][self._index]
+
+    def __setitem__(self, col, value):
+        self._state._writable(col)[self._index] = value
+
+    def __iter__(self):
+        for col in self._state._cols:
+            yield col[self._index]
+
+class TypedColumn():
+    """
+    Compact column of converted grades: floats, an array('d') (NaN
+    where MISSING; or a read-only memoryview of doubles, as from
+    gradebook.to_state), and missing, a bytearray (1 where MISSING), as
+    from convert_column_typed.  Reads as a sequence of floats and MISSING
+    values; it takes 9 bytes per student, rather than a list's
+    pointer plus (unless shared) a float object.
+    """
+    __slots__ = ('floats', 'missing')
+
+    def __init__(self, floats=None, missing=None):
+        self.floats = array.array('d') if floats is None else floats
+        self.missing = bytearray() if missing is None else missing
+
+    def extend(self, floats, missing):
+        """ Append the grades given by floats and missing mask. """
+        self.floats.extend(floats)
+        self.missing.extend(missing)
+
+    def __len__(self):
+        return len(self.floats)
+
+    def __getitem__(self, stu):
+        if isinstance(stu, slice):
+            return self.tolist()[stu]
+        if self.missing[stu]:
+            return MISSING
+        return self.floats[stu]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        """ Return new list of the column's floats and MISSING values. """
+        values = self.floats.tolist()
+        stu = self.missing.find(1)
+        while stu >= 0:
+            values[stu] = MISSING
+            stu = self.missing.find(1, stu + 1)
+        return values
+
 ##############################################################################
 ## Beginning of ranking program
 ##############################################################################
@@ -61,14 +330,14 @@ def read_csv(input_filename):
     converted to numeric data types as appropriate.
     """
     print("Reading input file:", input_filename)
-    with open(input_filename, 'rU') as csvfile:
+    with open(input_filename, newline='') as csvfile:
         reader = csv.reader(csvfile)
         return [row for row in reader]
 
-def parse_csv(rows, skiprows=0, maxgraderows=10000):
+def parse_csv(rows, skiprows=0, maxgraderows=None):
     """
     Parse given list of rows from CSV file.
-    Return a new State with
+    Return a new (copy-on-write) CowState with
        column names,
        column perfect_grades
        column weights
@@ -84,17 +353,82 @@ def parse_csv(rows, skiprows=0, maxgraderows=10000):
           (a zero, non-numeric or missing weight means to ignore this
                column for grade; it will be converted to zero internally)
         a number of rows of data, one per student
-    At most the first 'maxgraderows' of student grade data will be read.
+    If maxgraderows is given, at most that many rows (counting the
+    header, perfect_grade and weight rows) will be read.
     """
     rows = rows[skiprows:]
-    names = rows[0]
+    names, perfect_grades, weights = parse_header(rows[0], rows[1], rows[2])
+    grades = rows[3:maxgraderows]
+    return CowState(names, perfect_grades, weights, grades)
+
+def parse_header(names, perfect_grades, weights):
+    """
+    Return column names, perfect_grades and weights, parsed from the
+    header, perfect_grade and weight rows of the CSV file.
+    """
     names = [name.strip() for name in names]
-    perfect_grades = rows[1]
     perfect_grades = [max(0, convert_to_float_if_possible(pg, 0)) for pg in perfect_grades]
-    weights = rows[2]
     weights = [max(0, convert_to_float_if_possible(w, 0)) for w in weights]
-    grades = rows[3:maxgraderows]
-    return State(names, perfect_grades, weights, grades)
+    return names, perfect_grades, weights
+
+def read_grades(input_filename, skiprows=0, progress=None, progress_rows=100000):
+    """
+    Read CSV file in the format described in parse_csv, and return
+    a new CowState with its grade data already converted as by
+    convert_data.  This is equivalent to
+        convert_data(parse_csv(read_csv(input_filename), skiprows))
+    but streams through the file: each grade row is split into the
+    columns as it is read, and the cells read are converted (by
+    convert_column_typed) every 'progress_rows' rows, so no list of
+    string rows is ever built, and there is no limit on the number of
+    rows.  The weighted columns are kept as TypedColumns.
+
+    If progress is given, progress(n_rows, chars_read, file_size) is
+    called after every 'progress_rows' grade rows.
+    """
+    file_size = os.path.getsize(input_filename)
+    chars_read = 0
+    with open(input_filename, newline='') as csvfile:
+        def lines():
+            nonlocal chars_read
+            for line in csvfile:
+                chars_read += len(line)
+                yield line
+        reader = csv.reader(lines())
+        for _ in range(skiprows):
+            next(reader)
+        names, perfect_grades, weights = \
+            parse_header(next(reader), next(reader), next(reader))
+        cols = [[] for name in names]
+        weighted = [col for col, w in enumerate(weights) if w > 0]
+        typed = {col: TypedColumn() for col in weighted}
+        memos = {col: dict() for col in weighted}
+        def convert_chunk():
+            # convert the cells read since the last chunk
+            for col in weighted:
+                typed[col].extend(*convert_column_typed(cols[col],
+                                                        memos[col]))
+                cols[col].clear()
+        appends = [col.append for col in cols]
+        n_rows = 0
+        for row in reader:
+            assert len(row) == len(names)
+            for append, datum in zip(appends, row):
+                append(datum)
+            n_rows += 1
+            if n_rows % progress_rows == 0:
+                convert_chunk()
+                if progress is not None:
+                    progress(n_rows, chars_read, file_size)
+        convert_chunk()
+    for col in weighted:
+        cols[col] = typed[col]
+    return CowState.from_columns(names, perfect_grades, weights, cols)
+
+def print_read_progress(n_rows, chars_read, file_size):
+    """ Print progress of read_grades. """
+    print("  ... %d rows read (%.0f%%)"
+          % (n_rows, 100.0 * chars_read / max(1, file_size)))
 
 # MISSING DATA (marked by sentinel value "--")
 MISSING = "--"
@@ -115,10 +449,82 @@ def convert_to_float_if_possible(x, elsevalue=MISSING):
     Return float version of value x, else elsevalue
     (MISSING or other specified value) if conversion fails
     """
-    if isnonnumeric(x):
-        return elsevalue
-    else:
+    try:
         return float(x)
+    except ValueError:
+        return elsevalue
+
+# cells known not to convert to floats (e.g. as written by make_data.py)
+MISSING_CELLS = ["", " ", MISSING, " "+MISSING, MISSING+" "]
+MAX_MEMO = 10000     # most distinct cells remembered per column
+NAN = float("nan")
+
+def convert_column(values, memo=None):
+    """
+    Return list of values converted as by convert_to_float_if_possible.
+
+    Each distinct cell is converted just once, and the result remembered
+    in memo (a dict, which may be passed in again for more values of the
+    same column); gradebooks have few distinct cells per column (e.g.
+    " --", "  5").  Blank and MISSING cells are known in advance, so no
+    exception is raised for them.  Floats (already converted) are kept.
+    """
+    if memo is None:
+        memo = dict()
+    if not memo:
+        for cell in MISSING_CELLS:
+            memo[cell] = MISSING
+    converted = []
+    append = converted.append
+    get = memo.get
+    for x in values:
+        if type(x) is float:
+            append(x)
+            continue
+        value = get(x)
+        if value is None:
+            value = convert_to_float_if_possible(x)
+            if len(memo) < MAX_MEMO:
+                memo[x] = value
+        append(value)
+    return converted
+
+def convert_column_typed(values, memo=None):
+    """
+    Return values converted as by convert_column, as a typed array of
+    floats (array('d'), with NaN for MISSING), and a missing mask (a
+    bytearray, 1 for MISSING).  The results are written straight into
+    the array and mask; no list of converted values is built.  (memo is
+    as for convert_column; floats in values are kept.)
+    """
+    if isinstance(values, TypedColumn):
+        floats = array.array('d')
+        floats.frombytes(values.floats)
+        return floats, bytearray(values.missing)
+    if memo is None:
+        memo = dict()
+    if not memo:
+        for cell in MISSING_CELLS:
+            memo[cell] = MISSING
+    # convert each distinct cell once, then fill the array and mask by
+    # looking the cells up
+    float_of = dict()
+    missing_of = dict()
+    for x in set(values):
+        value = memo.get(x)
+        if value is None:
+            value = x if type(x) is float else convert_to_float_if_possible(x)
+            if len(memo) < MAX_MEMO:
+                memo[x] = value
+        if value is MISSING:
+            float_of[x] = NAN
+            missing_of[x] = 1
+        else:
+            float_of[x] = value
+            missing_of[x] = 0
+    floats = array.array('d', map(float_of.__getitem__, values))
+    missing = bytearray(map(missing_of.__getitem__, values))
+    return floats, missing
 
 def convert_data(state):
     """
@@ -127,11 +533,8 @@ def convert_data(state):
     """
     new_state = state.copy()
     for col in state.columns:
-        w = convert_to_float_if_possible(state.weights[col], 0)
-        if w > 0:
-            for stu in state.students:
-                new_state.data[stu][col] = \
-                    convert_to_float_if_possible(state.data[stu][col])
+        if state.weights[col] > 0:
+            new_state.set_column(col, convert_column(state.column(col)))
     return new_state
 
 def print_grade_components(state):
@@ -157,56 +560,364 @@ def datum_str(datum, width, sep):
         else:
             return ("%"+str(width)+".3f"+sep)%float(datum)
 
+def datum_text(datum):
+    """
+    Return string rep of data item, unpadded; the same as
+    datum_str(datum, 0, ""), but quicker for floats.
+    """
+    if type(datum) is float:
+        if datum == int(datum):
+            return "%d"%int(datum)
+        return "%.3f"%datum
+    return datum_str(datum, 0, "")
+
+class OutputTable():
+    """
+    Column widths for aligned output of a state: the column names, and
+    the length of the longest formatted cell (by datum_text) in each
+    column, found as the rows are added.  The rows themselves aren't
+    kept; lines formats them again as it prints them.
+    """
+    def __init__(self, names):
+        self.names = [str(name.strip()) for name in names]
+        self.n_rows = 0
+        self.max_len = [0 for name in names]
+
+    def add_row(self, cells):
+        """ Note lengths of a row of formatted cells. """
+        self.n_rows += 1
+        self.max_len = [max(m, len(cell))
+                        for m, cell in zip(self.max_len, cells)]
+
+    def widths(self, sep):
+        """ Return width of each column when aligned with separator sep. """
+        if not self.n_rows:
+            return [len(name) for name in self.names]
+        return [max(len(name), m + len(sep))
+                for name, m in zip(self.names, self.max_len)]
+
+    def lines(self, sep, rows):
+        """
+        Generate lines of aligned output (as build_output gives them)
+        for the given rows of formatted cells (the rows added, e.g. from
+        output_rows again), with each item right-justified and followed
+        by sep.
+        """
+        widths = self.widths(sep)
+        yield "".join([name.rjust(w) + sep
+                       for name, w in zip(self.names, widths)]) + "\n"
+        for cells in rows:
+            yield "".join([cell.rjust(w) + sep
+                           for cell, w in zip(cells, widths)]) + "\n"
+
+def output_rows(state):
+    """ Generate the formatted cells of each data row of state. """
+    data_cols = [state.column(col) for col in state.columns]
+    for row in zip(*data_cols):
+        yield [datum_text(datum) for datum in row]
+
+def write_output(state, file, table=None):
+    """
+    Write state to file in CSV form, one row at a time: names, and then
+    the rows in data (one per student), with each item followed by ", ".
+    Items are not padded (aligned output is only for the terminal).
+    If an OutputTable is given, the formatted rows are added to it too
+    (so it finds the column widths).
+    """
+    file.write("".join([str(name.strip()) + ", " for name in state.names]))
+    file.write("\n")
+    for cells in output_rows(state):
+        file.write(", ".join(cells))
+        file.write(", \n")
+        if table is not None:
+            table.add_row(cells)
+
 def build_output(state, sep):
     """
     Build and return string for later output to file (or equivalent I/O).
     Give names, weights, and then the rows in data (one per student).
     Sep is what to put between data elements:
         either "," (for csv use) or " " (for screen).
+    Items are aligned in columns.  (For large states, write_output and
+    OutputTable.lines avoid holding the whole output as one string.)
     """
+    rows = list(output_rows(state))
+    table = OutputTable(state.names)
+    for cells in rows:
+        table.add_row(cells)
+    return "".join(table.lines(sep, rows))
 
-    # first compute column widths for printing
-    width = [0]*(state.n_col+1)
-    for col, name in enumerate(state.names):
-        width[col] = max(width[col], len(str(name.strip())))
-    for stu in state.students:
-        for col in state.columns:
-            datum = state.data[stu][col]
-            width[col] = max(width[col], len(datum_str(datum, 0, sep)))
-
-    # now build list of items for output
-    items = []
-    for col, name, in enumerate(state.names):
-        items.append(("%"+str(width[col])+"s"+sep)%(name.strip()))
-    items.append("\n")
-    # Data rows, one per student:
-    for stu in state.students:
-        for col in state.columns:
-            datum = state.data[stu][col]
-            items.append(datum_str(datum, width[col], sep))
-        items.append("\n")
-    return "".join(items)
-
-def compute_scores(state):
+def compute_scores(state, jobs=1, rank_weight=None, cache=None,
+                   sketches=None):
     """
     Return new state with data converted to rank-based scores.
+    If jobs > 1, the columns are scored by that many worker processes.
+    rank_weight defaults to policy.RANK_WEIGHT.
+    If a scorecache.ScoreCache is given, columns found in it are not
+    rescored; the others are scored and then added to it.
+    If sketches are given (see compute_scores_approx), the scores are
+    approximate, and the cache is not used.
+    """
+    if sketches is not None:
+        return compute_scores_approx(state, sketches, rank_weight)
+    if cache is not None:
+        return compute_scores_cached(state, cache, jobs, rank_weight)
+    if jobs > 1:
+        beats, stu_per_comp = compute_beats_parallel(state, jobs)
+    else:
+        beats, stu_per_comp = compute_beats(state)
+    return normalize_scores(state, beats, stu_per_comp, rank_weight)
+
+def compute_scores_cached(state, cache, jobs=1, rank_weight=None):
+    """
+    Version of compute_scores that takes the scores of unchanged columns
+    from cache, and scores just the other columns (as a separate state).
+    """
+    if rank_weight is None:
+        rank_weight = policy.RANK_WEIGHT
+    new_state = state.copy()
+    keys = dict()
+    for col in state.columns:
+        if state.weights[col] > 0:
+            key = cache.key(state.column(col), state.perfect_grades[col],
+                            rank_weight)
+            scores = cache.get(key)
+            if scores is None:
+                keys[col] = key
+            else:
+                new_state.set_column(col, scores)
+    if keys:
+        cols = sorted(keys)
+        miss_state = CowState.from_columns(
+            [state.names[col] for col in cols],
+            [state.perfect_grades[col] for col in cols],
+            [state.weights[col] for col in cols],
+            [list(state.column(col)) for col in cols])
+        miss_scores = compute_scores(miss_state, jobs, rank_weight)
+        for i, col in enumerate(cols):
+            scores = miss_scores.column(i)
+            new_state.set_column(col, scores)
+            cache.put(keys[col], scores)
+        cache.evict()
+    return new_state
+
+def compute_scores_approx(state, sketches, rank_weight=None):
+    """
+    Version of compute_scores that estimates each student's beats count
+    from sketches, a dict mapping each weighted column to a
+    sketch.QuantileSketch of its grades (as from sketch.build_sketches;
+    e.g. kept up to date as grades come in, or merged from the sketches
+    of several sections).  Each estimate takes O(log k) time, for
+    sketches of size k.  The scores are exact if no sketch has been
+    compacted; otherwise see sketch.QuantileSketch.error_bound.
+    """
+    beats = [[0 for col in state.columns] for stu in state.students]
+    stu_per_comp = [0 for col in state.columns]
+    for col in state.columns:
+        if state.weights[col] > 0:
+            col_sketch = sketches[col]
+            stu_per_comp[col] = col_sketch.count
+            for stu, d in enumerate(state.column(col)):
+                if not ismissing(d):
+                    beats[stu][col] = col_sketch.beats(d)
+    return normalize_scores(state, beats, stu_per_comp, rank_weight)
+
+def compare_approx(grade_state, sketches, policy=policy, jobs=1):
+    """
+    Compare approximate scores (from sketches, see compute_scores_approx)
+    with exact ones, for validation.  Return the largest difference
+    between an approximate and an exact score, and the largest
+    difference between a student's approximate and exact final rank (of
+    scores after dropping, if the drop policy has any items).
+    """
+    approx_state = compute_scores(grade_state, 1, policy.RANK_WEIGHT,
+                                  sketches=sketches)
+    exact_state = compute_scores(grade_state, jobs, policy.RANK_WEIGHT)
+    score_error = 0.0
+    for col in grade_state.columns:
+        if grade_state.weights[col] > 0:
+            for a, e in zip(approx_state.column(col),
+                            exact_state.column(col)):
+                if not ismissing(a):
+                    score_error = max(score_error, abs(a - e))
+    def final_ranks(score_state):
+        if policy.DROP_POLICY != []:
+            score_state = policy.drop(score_state, policy.DROP_POLICY, False)
+        return ranks_of(policy.compute_wtd_scores(score_state))
+    rank_error = max([abs(a - e) for a, e in zip(final_ranks(approx_state),
+                                                 final_ranks(exact_state))],
+                     default=0)
+    return score_error, rank_error
+
+def compute_beats(state):
+    """
+    Return beats and stu_per_comp for the weighted columns of state.
+
+    beats[stu][col] is number of other students in same column
+        this student beats
+    where a student beats himself by one (+1)
+    and beats others with same score by one-half (0.5).
+    stu_per_comp[col] is number of students with data in column col.
+
+    This takes O(n_stu log n_stu) time per column (see column_beats);
+    the result is identical to that of compute_beats_allpairs.
+    """
+    stu_per_comp = [0  for col in state.columns]
+    beats = [[0 for col in state.columns] for stu in state.students]
+    for col in state.columns:
+        if state.weights[col] > 0:
+            col_beats, stu_per_comp[col] = column_beats(state.column(col))
+            for stu in state.students:
+                beats[stu][col] = col_beats[stu]
+    return beats, stu_per_comp
+
+def column_beats(values, order=None):
+    """
+    Return list of beats for each student in a column with the given
+    values (0 for MISSING values), and the number of students with data.
+
+    The column is sorted once, so a student's count is just the number
+    of strictly lower grades below his group of equal grades.
+    If order is given, it should list the students with (non-NaN) data
+    in roughly increasing order of value (e.g. the order for similar
+    values); sorting it is then much faster.
+    """
+    beats = [0 for d in values]
+    n = 0
+    L = []
+    for stu, d in enumerate(values):
+        if not ismissing(d):
+            n += 1
+            if d != d:
+                # NaN is equal to and greater than nothing,
+                # so it only beats itself
+                beats[stu] = 1.0
+            elif order is None:
+                L.append(stu)
+    if order is not None:
+        L = list(order)
+    L.sort(key=values.__getitem__)
+    below = 0
+    for d, group in itertools.groupby(L, key=values.__getitem__):
+        # group of tied students
+        group = list(group)
+        value = below + 0.5*(len(group)-1) + 1.0
+        for stu in group:
+            beats[stu] = value
+        below += len(group)
+    return beats, n
+
+def column_beats_typed(grades, missing):
+    """
+    Version of column_beats for a column given as a buffer of floats
+    (e.g. an array('d') or a memoryview cast to 'd') and a missing mask
+    (1 where the grade is MISSING), as from convert_column_typed.
+    Return the beats as an array('d'), and the number of students
+    with data.
+    """
+    values = grades.tolist()
+    beats = array.array('d', bytes(8*len(values)))
+    n = 0
+    L = []
+    for stu, m in enumerate(missing):
+        if not m:
+            n += 1
+            d = values[stu]
+            if d != d:
+                # NaN only beats itself (see column_beats)
+                beats[stu] = 1.0
+            else:
+                L.append(stu)
+    L.sort(key=values.__getitem__)
+    below = 0
+    for d, group in itertools.groupby(L, key=values.__getitem__):
+        group = list(group)
+        value = below + 0.5*(len(group)-1) + 1.0
+        for stu in group:
+            beats[stu] = value
+        below += len(group)
+    return beats, n
+
+def compute_beats_parallel(state, jobs):
+    """
+    Version of compute_beats that scores the weighted columns in a pool
+    of 'jobs' worker processes, with identical results.
+
+    Rather than pickling the state for each worker, the (converted)
+    weighted columns are put into one block of shared memory:
+        n_wcol*n_stu float64 grades,
+        n_wcol*n_stu float64 beats, written by the workers, and
+        n_wcol*n_stu bytes, 1 where grade is MISSING.
+    Each worker is just told the block's name and which column to score.
+    Columns go in and beats come out by whole-column slice assignment.
+    """
+    stu_per_comp = [0  for col in state.columns]
+    wcols = [col for col in state.columns if state.weights[col] > 0]
+    n_stu = state.n_stu
+    n = n_stu * len(wcols)
+    if n == 0:
+        return [[0 for col in state.columns] for stu in state.students], \
+            stu_per_comp
+    shm = shared_memory.SharedMemory(create=True, size=17*n)
+    try:
+        # views of shm.buf must be released before shm is closed (even
+        # on an error), or closing raises BufferError, hiding the error
+        with shm.buf[:8*n].cast('d') as grades, \
+             shm.buf[16*n:17*n] as missing:
+            for k, col in enumerate(wcols):
+                floats, mask = state.typed_column(col)
+                grades[k*n_stu:(k+1)*n_stu] = floats
+                missing[k*n_stu:(k+1)*n_stu] = mask
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            counts = list(pool.map(_column_beats_worker,
+                                   [(shm.name, n_stu, len(wcols), k)
+                                    for k in range(len(wcols))]))
+        zeros = [0] * n_stu
+        cols = [zeros for col in state.columns]
+        with shm.buf[8*n:16*n].cast('d') as col_beats:
+            for k, col in enumerate(wcols):
+                stu_per_comp[col] = counts[k]
+                cols[col] = col_beats[k*n_stu:(k+1)*n_stu].tolist()
+    finally:
+        shm.close()
+        shm.unlink()
+    beats = [list(row) for row in zip(*cols)]
+    return beats, stu_per_comp
+
+def _column_beats_worker(args):
+    """
+    Worker for compute_beats_parallel: score column k of the grades in
+    the named shared memory block, and return the number of students
+    with data in it.
+    """
+    shm_name, n_stu, n_wcol, k = args
+    n = n_stu * n_wcol
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        with shm.buf[8*k*n_stu:8*(k+1)*n_stu].cast('d') as grades, \
+             shm.buf[16*n + k*n_stu:16*n + (k+1)*n_stu] as missing:
+            col_beats, count = column_beats_typed(grades, missing)
+        with shm.buf[8*(n + k*n_stu):8*(n + (k+1)*n_stu)].cast('d') as out:
+            out[:] = col_beats
+    finally:
+        shm.close()
+    return count
+
+def compute_beats_allpairs(state):
+    """
+    Reference version of compute_beats, comparing all pairs of students.
+    Takes O(n_stu^2 * n_col) time; kept for cross-checking compute_beats.
     """
     stu_per_comp = [0  for col in state.columns]
-    weight_per_stu = [0 for stu in state.students]
     beats = [[0 for col in state.columns] for stu in state.students]
 
     # compare all pairs stu,stu2 of students
-    # beats[stu][col] is number of other students in same column
-    #     this student beats
-    # where a student beats himself by one (+1)
-    # and beats others with same score by one-half (0.5)
     for stu in state.students:
         for col in state.columns:
             if state.weights[col] > 0:
                 d1 = state.data[stu][col]
                 if not ismissing(d1):
                     stu_per_comp[col] += 1
-                    weight_per_stu[stu] += state.weights[col]
                     for stu2 in state.students:
                         d2 = state.data[stu2][col]
                         if not ismissing(d2):
@@ -216,65 +927,263 @@ def compute_scores(state):
                                 beats[stu][col] += 0.5
                             elif d1 > d2:
                                 beats[stu][col] += 1.0
+    return beats, stu_per_comp
+
+def compute_scores_allpairs(state):
+    """
+    Reference version of compute_scores, using compute_beats_allpairs.
+    """
+    beats, stu_per_comp = compute_beats_allpairs(state)
     return normalize_scores(state, beats, stu_per_comp)
 
-def normalize_scores(state, beats, stu_per_comp):
+def normalize_scores(state, beats, stu_per_comp, rank_weight=None):
     """
     Return normalized scores (in beats) to [0,1] by dividing by
     one plus the number of students in the component component
     preserve missing or other data "as is"
+    rank_weight defaults to policy.RANK_WEIGHT.
     """
-    rank_weight = policy.RANK_WEIGHT
+    if rank_weight is None:
+        rank_weight = policy.RANK_WEIGHT
     new_state = state.copy()
-    for stu in state.students:
-        for col in state.columns:
-            if state.weights[col] > 0:
-                if not ismissing(state.data[stu][col]):
+    for col in state.columns:
+        if state.weights[col] > 0:
+            values = []
+            for stu, d in enumerate(state.column(col)):
+                if not ismissing(d):
                     rank_value =  beats[stu][col] / (float(stu_per_comp[col]) + 1.0)
-                    grade_value = state.data[stu][col] / state.perfect_grades[col]
+                    grade_value = d / state.perfect_grades[col]
                     value = rank_weight*rank_value + (1-rank_weight)*grade_value
                 else:
                     value = MISSING
-            else:
-                value = state.data[stu][col]
-            new_state.data[stu][col] = value
+                values.append(value)
+            new_state.set_column(col, values)
     return new_state
 
 def sort_state(state, key_name):
     """ Sort data into decreasing order by key with given name"""
     key_col = state.names.index(key_name)
-    L = sorted([(state.data[stu][key_col], stu)
-                for stu in state.students],
+    L = sorted([(ws, stu)
+                for stu, ws in enumerate(state.column(key_col))],
                reverse=True)
     stu_order = [stu for (ws, stu) in L]
     new_state = state.copy()
-    new_data = [new_state.data[stu] for stu in stu_order]
-    new_state.data = new_data
+    new_state.reorder(stu_order)
     return new_state
 
 def add_column(state, new_name, new_perfect_grade, new_weight, values):
     """ Return state with new column added. """
     new_state = state.copy()
-    new_state.names.append(new_name)
-    new_state.perfect_grades.append(new_perfect_grade)
-    new_state.weights.append(new_weight)
-    new_state.n_col += 1
-    new_state.columns = list(range(new_state.n_col))
-    for stu in state.students:
-        new_state.data[stu].append(values[stu])
+    new_state.append_column(new_name, new_perfect_grade, new_weight, values)
     return new_state
 
-def print_and_write_to_file(title, state, file_name):
+def rank_by(state, wtd_score, stu_order=None):
+    """
+    Return state with given wtd_score column added, sorted into
+    decreasing order by wtd_score, and with a rank column added.
+    If stu_order is given, it is that order of the students (e.g. from
+    columnar.rank_order), which is used instead of sorting again.
+    """
+    new_state = add_column(state, "wtd_score", 0, 0, wtd_score)
+    if stu_order is None:
+        new_state = sort_state(new_state, "wtd_score")
+    else:
+        new_state.reorder(stu_order)
+    return add_column(new_state, "rank", 0, 0,
+                      list(range(1, state.n_stu+1)))
+
+def ranks_of(wtd_score):
+    """
+    Return rank (1 for best) of each student, for given weighted scores;
+    the same ranks as given by rank_by (ties broken as by sort_state).
+    """
+    L = sorted([(ws, stu) for stu, ws in enumerate(wtd_score)], reverse=True)
+    ranks = [0 for ws in wtd_score]
+    for r, (ws, stu) in enumerate(L):
+        ranks[stu] = r + 1
+    return ranks
+
+def select_best(wtd_score, k=None, min_score=None):
+    """
+    Return list of the students rank_by would put first, best first:
+    the k best, or (if min_score is given) all those with weighted
+    score at least min_score.  Ties are broken just as by sort_state.
+
+    Only the selected students are sorted: this takes O(n_stu log k)
+    time for the k best (heapq.nlargest; close to O(n_stu) when k is
+    small), and O(n_stu + k log k) time for the k above min_score.
+    """
+    keyed = zip(wtd_score, range(len(wtd_score)))
+    if min_score is not None:
+        L = sorted([(ws, stu) for ws, stu in keyed if ws >= min_score],
+                   reverse=True)
+    else:
+        L = heapq.nlargest(k, keyed)
+    return [stu for (ws, stu) in L]
+
+def best_rows(state, wtd_score, selected):
+    """
+    Return state with just the rows of the selected students (a list of
+    the best students, best first, as from select_best), and with the
+    wtd_score and rank columns added; i.e. the first rows of
+    rank_by(state, wtd_score).
+    """
+    rows = [list(state.data[stu]) + [wtd_score[stu], r + 1]
+            for r, stu in enumerate(selected)]
+    return CowState(state.names + ["wtd_score", "rank"],
+                    state.perfect_grades + [0, 0],
+                    state.weights + [0, 0], rows)
+
+def rank_query(grade_state, k=None, min_score=None, policy=policy, jobs=1,
+               use_columnar=False, grade_cstate=None, cache=None,
+               sketches=None):
+    """
+    Return state with just the best students of the final ranking (of
+    scores after dropping, if the drop policy has any items), as in the
+    first rows of the last state of rank_pipeline: the k best, or those
+    with weighted score at least min_score (see select_best).
+    The other students are never sorted, and nothing is printed.
+    grade_cstate, cache and sketches are as for rank_pipeline.
+    """
+    if use_columnar:
+        if grade_cstate is None:
+            grade_cstate = columnar.from_state(grade_state)
+        score_cstate = columnar.compute_scores(grade_cstate,
+                                               policy.RANK_WEIGHT)
+        if policy.DROP_POLICY != []:
+            plan = policy.compile_drop_policy(grade_state.names,
+                                              policy.DROP_POLICY)
+            score_cstate = columnar.drop(score_cstate, plan)
+        wtd_score = columnar.compute_wtd_scores(score_cstate)
+        score_state = \
+            CowState.from_columns(*columnar.to_columns(score_cstate))
+    else:
+        score_state = compute_scores(grade_state, jobs, policy.RANK_WEIGHT,
+                                     cache, sketches)
+        if policy.DROP_POLICY != []:
+            score_state = policy.drop(score_state, policy.DROP_POLICY, False)
+        wtd_score = policy.compute_wtd_scores(score_state)
+    return best_rows(score_state, wtd_score,
+                     select_best(wtd_score, k, min_score))
+
+class RankResult():
+    """
+    Result of rank_pipeline, consisting of three states, each
+    sorted best first and with wtd_score and rank columns added:
+        grade_state     raw grades
+        score_state     scaled scores
+        dropped_state   scaled scores after dropping according to
+                        the drop policy (None if there is no drop policy)
+    """
+    def __init__(self, grade_state, score_state, dropped_state):
+        self.grade_state = grade_state
+        self.score_state = score_state
+        self.dropped_state = dropped_state
+
+def rank_pipeline(grade_state, policy=policy, jobs=1, use_columnar=False,
+                  verbose=False, profiler=None, grade_cstate=None,
+                  cache=None, sketches=None):
+    """
+    Rank the students in grade_state (whose data has been converted,
+    as by convert_data or read_grades), and return a RankResult.
+
+    policy is the policy module to follow (by default, policy.py), or
+    any object with RANK_WEIGHT, DROP_POLICY, compute_wtd_scores and drop
+    (and, if use_columnar, print_drop_policy and compile_drop_policy).
+    If jobs > 1, columns are scored by that many worker processes;
+    if use_columnar, they are scored by the NumPy columnar backend.
+    If a profiling.Profiler is given, each stage is measured by it.
+    If use_columnar, the columnar version of grade_state may be given as
+    grade_cstate (e.g. from gradebook.load_columnar), to save converting it.
+    Otherwise, if a scorecache.ScoreCache is given, columns already
+    scored in an earlier run are taken from it (see compute_scores).
+    If sketches are given, the scores are approximated from them (see
+    compute_scores_approx).
+
+    Nothing is written to any file, and nothing is printed unless verbose.
+    """
+    if profiler is None:
+        profiler = profiling.NO_PROFILER
+
+    with profiler.stage("score") as stage:
+        if use_columnar:
+            if grade_cstate is None:
+                grade_cstate = columnar.from_state(grade_state)
+            score_cstate = columnar.compute_scores(grade_cstate,
+                                                   policy.RANK_WEIGHT)
+            score_state = \
+                CowState.from_columns(*columnar.to_columns(score_cstate))
+        else:
+            score_state = compute_scores(grade_state, jobs, policy.RANK_WEIGHT,
+                                         cache, sketches)
+        stage.set_counts(score_state)
+    with profiler.stage("wtd_score") as stage:
+        if use_columnar:
+            wtd_score = columnar.compute_wtd_scores(score_cstate)
+        else:
+            wtd_score = policy.compute_wtd_scores(score_state)
+        stage.set_counts(score_state)
+    with profiler.stage("sort") as stage:
+        stu_order = columnar.rank_order(wtd_score) if use_columnar else None
+        sorted_grade_state = rank_by(grade_state, wtd_score, stu_order)
+        sorted_score_state = rank_by(score_state, wtd_score, stu_order)
+        stage.set_counts(sorted_score_state)
+
+    dropped_state = None
+    if policy.DROP_POLICY != []:
+        # ADJUST: DROP WORST HOMEWORK, ETC. ACCORDING TO POLICY
+        with profiler.stage("drop") as stage:
+            if use_columnar:
+                if verbose:
+                    policy.print_drop_policy(grade_state.names,
+                                             policy.DROP_POLICY)
+                plan = policy.compile_drop_policy(grade_state.names,
+                                                  policy.DROP_POLICY)
+                adjusted_cstate = columnar.drop(score_cstate, plan)
+                adjusted_score_state = CowState.from_columns(
+                    *columnar.to_columns(adjusted_cstate))
+            else:
+                adjusted_score_state = policy.drop(score_state.copy(),
+                                                   policy.DROP_POLICY, verbose)
+            stage.set_counts(adjusted_score_state)
+        # THEN RECOMPUTE WEIGHTED SCORES AND NEW RANKS
+        if verbose:
+            print("Recomputing weighted scores and ranks...")
+        with profiler.stage("drop_wtd_score") as stage:
+            if use_columnar:
+                dropped_wtd_score = columnar.compute_wtd_scores(adjusted_cstate)
+            else:
+                dropped_wtd_score = \
+                    policy.compute_wtd_scores(adjusted_score_state)
+            stage.set_counts(adjusted_score_state)
+        with profiler.stage("drop_sort") as stage:
+            stu_order = None
+            if use_columnar:
+                stu_order = columnar.rank_order(dropped_wtd_score)
+            dropped_state = rank_by(adjusted_score_state, dropped_wtd_score,
+                                    stu_order)
+            stage.set_counts(dropped_state)
+
+    return RankResult(sorted_grade_state, sorted_score_state, dropped_state)
+
+def print_and_write_to_file(title, state, file_name, quiet=False):
     """
     Write data to terminal and to output file with given filename.
     Here data is grades or scores.
+    The file is written row by row as each row is formatted, noting
+    the widths of the formatted cells; the terminal listing is then
+    printed row by row, formatting the rows again and aligning them to
+    those widths.  So no more than a row is held in memory at a time.
+    If quiet, the listing isn't shown on the terminal at all.
     """
-    print("-"*80 + "\n" + title)
-    print(build_output(state, " "), end=' ')
-    print("-"*80)
+    table = None if quiet else OutputTable(state.names)
+    with open(file_name, "w", buffering=1<<16) as file:
+        write_output(state, file, table)
 
-    with open(file_name, "w") as file:
-        file.write(build_output(state, ", "))
+    if not quiet:
+        print("-"*80 + "\n" + title)
+        sys.stdout.writelines(table.lines(" ", output_rows(state)))
+        print(" " + "-"*80)
     print(file_name, "written.")
     print()
 
@@ -291,20 +1200,79 @@ def main():
     parser.add_argument(\
         'input_filename',
         help='csv file with header row, perfect_grade row, weight row, '\
-        'and then one grade row per student')
+        'and then one grade row per student (or a binary gradebook file '\
+        'made from one by gradebook.py)')
     parser.add_argument('--skiprows',
                         default=0,
                         help='number of rows to skip before header row')
+    parser.add_argument('--columnar',
+                        action='store_true',
+                        help='compute scores with the NumPy columnar backend')
+    parser.add_argument('--jobs',
+                        default=1,
+                        help='number of worker processes for scoring columns '\
+                        '(not used with --columnar)')
+    parser.add_argument('--profile',
+                        choices=['json', 'text'],
+                        help='measure time and memory of each stage, and '\
+                        'write report (json: to INPUT_FILENAME.profile.json)')
+    query = parser.add_mutually_exclusive_group()
+    query.add_argument('--top',
+                       help='only list the best TOP students (after dropping)')
+    query.add_argument('--above-percentile',
+                       help='only list the students ranked above this '\
+                       'percentile, e.g. 90 for the best 10%%')
+    query.add_argument('--min-score',
+                       help='only list the students with weighted score '\
+                       '(after dropping) at least MIN_SCORE')
+    parser.add_argument('--cache',
+                        help='directory in which to cache column scores, '\
+                        'so unchanged columns are not rescored on later runs '\
+                        '(not used with --columnar)')
+    parser.add_argument('--cache-size',
+                        default=100,
+                        help='maximum size of score cache, in MB')
+    parser.add_argument('--approx',
+                        help='approximate rank-based scores from quantile '\
+                        'sketches of this size (e.g. 4000), and report '\
+                        'the error bound (not used with --columnar)')
+    parser.add_argument('--approx-check',
+                        action='store_true',
+                        help='with --approx, also compute exact scores and '\
+                        'report the actual error')
+    parser.add_argument('--quiet',
+                        action='store_true',
+                        help="don't list students on the terminal "\
+                        '(just write the output files)')
     args = parser.parse_args()
+    if args.columnar and columnar is None:
+        parser.error("--columnar requires numpy")
 
     input_filename = args.input_filename
     skiprows = int(args.skiprows)
-    maxgraderows = 10000
+    jobs = int(args.jobs)
+    cache = None
+    if args.cache:
+        cache = scorecache.ScoreCache(args.cache,
+                                      int(float(args.cache_size)*1024*1024))
+    if args.approx_check and not args.approx:
+        parser.error("--approx-check requires --approx")
+    if args.profile:
+        profiler = profiling.Profiler()
+    else:
+        profiler = profiling.NO_PROFILER
 
     # READ AND CLEAN UP DATA
-    rows = read_csv(input_filename)
-    state = parse_csv(rows, skiprows, maxgraderows)
-    grade_state = convert_data(state)
+    with profiler.stage("read") as stage:
+        grade_cstate = None
+        print("Reading input file:", input_filename)
+        if gradebook is not None and gradebook.is_gradebook(input_filename):
+            grade_cstate = gradebook.load_columnar(input_filename)
+            grade_state = gradebook.to_state(grade_cstate)
+        else:
+            grade_state = read_grades(input_filename, skiprows,
+                                      progress=print_read_progress)
+        stage.set_counts(grade_state)
     print_grade_components(grade_state)
     print(grade_state.n_stu, "students")
 
@@ -312,57 +1280,89 @@ def main():
     print("The weight of rank-based scores is", policy.RANK_WEIGHT)
     print("The weight of grade-based scores is", 1.0-policy.RANK_WEIGHT)
 
+    sketches = None
+    if args.approx and not args.columnar:
+        print()
+        with profiler.stage("sketch") as stage:
+            sketches = sketch.build_sketches(grade_state, int(args.approx))
+            stage.set_counts(grade_state)
+        sketch.print_error_report(grade_state.names, sketches)
+        if args.approx_check:
+            score_error, rank_error = compare_approx(grade_state, sketches,
+                                                     policy, jobs)
+            bound = max([policy.RANK_WEIGHT * s.error_bound() / (s.count + 1.0)
+                         for s in sketches.values()], default=0.0)
+            print("Compared with exact scores: largest score error %.6f "
+                  "(bound %.6f), largest rank change %d"
+                  % (score_error, bound, rank_error))
+        print()
 
-    # COMPUTE SCALED SCORES AND WEIGHTED AVERAGE SCORES
-    # scores has one row per student,
-    # one column per original grades column
-    score_state = compute_scores(grade_state)
-    wtd_score = policy.compute_wtd_scores(score_state)
-
-    sorted_grade_state = add_column(grade_state,
-                                    "wtd_score", 0, 0, wtd_score)
-    sorted_grade_state = sort_state(sorted_grade_state,
-                                    "wtd_score")
-    sorted_grade_state = add_column(sorted_grade_state,
-                                    "rank", 0, 0, 
-                                    list(range(1, score_state.n_stu+1)))
-    sorted_score_state = add_column(score_state,
-                                    "wtd_score", 0, 0, wtd_score)
-    sorted_score_state = sort_state(sorted_score_state, "wtd_score")
-    sorted_score_state = \
-        add_column(sorted_score_state,
-                   "rank", 0, 0, list(range(1, score_state.n_stu+1)))
-
-    # OUTPUT RESULTS
-    title = "LISTING OF ALL STUDENTS (BEST FIRST) WITH RAW GRADES:"
-    print_and_write_to_file(title, sorted_grade_state,
-                            input_filename+".1.grades.rank.csv")
-
-    title = "LISTING OF ALL STUDENTS (BEST FIRST) WITH WEIGHTED SCALED SCORES:"
-    print_and_write_to_file(title, sorted_score_state,
-                            input_filename+".2.scores.rank.csv")
-
-    if policy.DROP_POLICY != []:
-        # ADJUST: DROP WORST HOMEWORK, ETC. ACCORDING TO POLICY
-        adjusted_score_state = policy.drop(score_state.copy())
+    if args.top or args.above_percentile or args.min_score:
+        # ONLY SELECT AND OUTPUT THE BEST STUDENTS
+        if args.top:
+            k, min_score = int(args.top), None
+        elif args.above_percentile:
+            percentile = float(args.above_percentile)
+            k, min_score = int(grade_state.n_stu*(100-percentile)/100), None
+        else:
+            k, min_score = None, float(args.min_score)
+        if policy.DROP_POLICY != []:
+            policy.print_drop_policy(grade_state.names, policy.DROP_POLICY)
+        with profiler.stage("query") as stage:
+            best_state = rank_query(grade_state, k, min_score, policy, jobs,
+                                    args.columnar, grade_cstate, cache,
+                                    sketches)
+            stage.set_counts(best_state)
+        with profiler.stage("write_best") as stage:
+            title = "LISTING OF THE BEST %d STUDENTS (BEST FIRST) "\
+                    "WITH FINAL SCORES:" % best_state.n_stu
+            print_and_write_to_file(title, best_state,
+                                    input_filename+".best.rank.csv",
+                                    args.quiet)
+            stage.set_counts(best_state)
+    else:
+        # COMPUTE SCALED SCORES, WEIGHTED AVERAGE SCORES AND RANKS
+        result = rank_pipeline(grade_state, policy, jobs, args.columnar,
+                               profiler=profiler, grade_cstate=grade_cstate,
+                               cache=cache, sketches=sketches)
+        if cache is not None:
+            print("Score cache: %d columns reused, %d rescored"
+                  % (cache.hits, cache.misses))
+            print()
 
-        # THEN RECOMPUTE WEIGHTED SCORES AND NEW RANKS
-        print("Recomputing weighted scores and ranks...")
-        wtd_score = policy.compute_wtd_scores(adjusted_score_state)
-        adjusted_score_state = add_column(adjusted_score_state,
-                                          "wtd_score", 0, 0, wtd_score)
-        sorted_adjusted_score_state = sort_state(adjusted_score_state,
-                                                 "wtd_score")
-        sorted_adjusted_score_state = \
-            add_column(sorted_adjusted_score_state,
-                       "rank", 0, 0, 
-                       list(range(1, adjusted_score_state.n_stu+1)))
+        # OUTPUT RESULTS
+        with profiler.stage("write_grades") as stage:
+            title = "LISTING OF ALL STUDENTS (BEST FIRST) WITH RAW GRADES:"
+            print_and_write_to_file(title, result.grade_state,
+                                    input_filename+".1.grades.rank.csv",
+                                    args.quiet)
+            stage.set_counts(result.grade_state)
 
-        title = "LISTING OF ALL STUDENTS (BEST FIRST) "\
-                "WITH SCALED AND DROPPED SCORES:"
-        print_and_write_to_file(title, sorted_adjusted_score_state,
-                                input_filename+".3.droppedscores.rank.csv")
+        with profiler.stage("write_scores") as stage:
+            title = "LISTING OF ALL STUDENTS (BEST FIRST) "\
+                    "WITH WEIGHTED SCALED SCORES:"
+            print_and_write_to_file(title, result.score_state,
+                                    input_filename+".2.scores.rank.csv",
+                                    args.quiet)
+            stage.set_counts(result.score_state)
 
-main()
+        if result.dropped_state is not None:
+            policy.print_drop_policy(grade_state.names, policy.DROP_POLICY)
+            print("Recomputing weighted scores and ranks...")
+            with profiler.stage("write_dropped") as stage:
+                title = "LISTING OF ALL STUDENTS (BEST FIRST) "\
+                        "WITH SCALED AND DROPPED SCORES:"
+                print_and_write_to_file(
+                    title, result.dropped_state,
+                    input_filename+".3.droppedscores.rank.csv", args.quiet)
+                stage.set_counts(result.dropped_state)
 
+    if args.profile == 'json':
+        profiler.write_json(input_filename+".profile.json")
+        print(input_filename+".profile.json", "written.")
+    elif args.profile == 'text':
+        print("PROFILE OF STAGES:")
+        profiler.print_report()
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# scorecache.py
+""" persistent cache of per-column scores for rank.py """
+# used by student ranking program rank.py (with --cache)
+
+"""
+A ScoreCache keeps the normalized scores of a column (as computed by
+rank.compute_scores) in a directory, one file per column, under a key
+that is a hash of the column's converted grades, its perfect grade and
+RANK_WEIGHT.  A column whose grades haven't changed since an earlier
+run (e.g. an old homework) is then not rescored: only new or changed
+columns are.
+
+Each file holds the column's scores as float64 values (NaN where
+MISSING), followed by one byte per student, 1 if MISSING.  The total
+size of the files is kept below max_bytes by removing the least
+recently used files (by modification time, which is updated on each
+use).
+"""
+
+import array
+import hashlib
+import os
+import tempfile
+
+MISSING = "--"
+def ismissing(x):
+    """ Return True if x is MISSING. """
+    return x == MISSING
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+NAN = float("nan")
+
+def encode_column(values):
+    """
+    Return bytes encoding a column of floats or MISSING values:
+    float64 values (NaN for MISSING) then one missing flag per value.
+    """
+    return array.array('d', [NAN if ismissing(d) else d
+                             for d in values]).tobytes() \
+        + bytes([ismissing(d) for d in values])
+
+def decode_column(data):
+    """ Return column of floats or MISSING values encoded in data. """
+    n = len(data) // 9
+    values = array.array('d')
+    values.frombytes(data[:8*n])
+    values = values.tolist()
+    for stu, m in enumerate(data[8*n:]):
+        if m:
+            values[stu] = MISSING
+    return values
+
+class ScoreCache():
+    """
+    Cache of column scores in directory 'directory' (created if need be),
+    holding at most max_bytes of scores.
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, values, perfect_grade, rank_weight):
+        """
+        Return key for the scores of a column with given (converted)
+        grades and perfect_grade, with given rank_weight.
+        """
+        h = hashlib.sha256(b"rank.py column scores v1\n")
+        h.update(("%r %r\n" % (float(perfect_grade), float(rank_weight)))
+                 .encode("ascii"))
+        h.update(encode_column(values))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".scores")
+
+    def get(self, key):
+        """ Return cached scores for key, or None if not cached. """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)              # mark as recently used
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decode_column(data)
+
+    def put(self, key, scores):
+        """
+        Store scores for key.  (Call evict after storing, to keep the
+        cache within its size.)  The scores are written to a uniquely
+        named temporary file and then renamed, so concurrent runs sharing
+        the directory never see a partly written entry.  Failure to
+        store (e.g. a full disk) just leaves the entry uncached.
+        """
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(encode_column(scores))
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache holds at most
+        max_bytes.
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".scores"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue            # removed by another run
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+                total += stat.st_size
+        entries.sort()
+        for mtime, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
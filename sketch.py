@@ -0,0 +1,224 @@
+# sketch.py
+""" mergeable quantile sketches, for approximate rank-based scores """
+# used by student ranking program rank.py (with --approx)
+
+"""
+A QuantileSketch summarizes the grades of one component in a small,
+bounded amount of memory (a KLL sketch: Karnin, Lang and Liberty,
+"Optimal quantile approximation in streams", 2016), from which the
+number of grades below a given grade, and so a student's beats count
+(see rank.compute_beats), can be estimated by binary search.
+
+Grades can be added one at a time as they come in (update), and the
+sketches of different sections or shards of a class can be merged
+(merge), giving a sketch of the whole class.
+
+The sketch keeps its grades in levels; a grade at level h stands for
+2**h grades.  When a level is full it is compacted: sorted, and every
+other grade (starting at a random one of the first two) moved up to
+the next level.  A sketch that has never been compacted is exact.
+Each compaction of level h changes the estimated number of grades
+below any given grade by at most 2**h (and by zero on average), so the
+sketch keeps track of a bound on its error:
+
+    max_error       the sum of 2**h over all compactions: the estimated
+                    count of grades below any grade is never off by more
+    error_bound(c)  a bound holding with probability c (by Hoeffding's
+                    inequality, as the errors are independent), which is
+                    typically much smaller
+
+Both are in numbers of students; divided by the number of students
+they give the error in the rank-based part of the score (before
+multiplying by RANK_WEIGHT).
+"""
+
+import bisect
+import math
+import random
+
+MISSING = "--"
+def ismissing(x):
+    """ Return True if x is MISSING. """
+    return x == MISSING
+
+DEFAULT_K = 4000            # capacity of the top level of a sketch
+MIN_CAPACITY = 8            # capacity of the lowest levels
+CAPACITY_RATIO = 2.0 / 3.0  # each level holds this times the next
+
+class QuantileSketch():
+    """
+    KLL sketch of a stream of grades (floats; NaN grades are only
+    counted), with top level capacity k.  Random choices are made by a
+    generator seeded with seed, so a sketch is reproducible.
+    """
+    def __init__(self, k=DEFAULT_K, seed=1):
+        self.k = k
+        self.levels = [[]]          # levels[h]: grades of weight 2**h
+        self.n = 0                  # number of (non-NaN) grades added
+        self.n_nan = 0              # number of NaN grades added
+        self.max_error = 0          # sum of weights of compactions
+        self.sum_sq_error = 0       # sum of squared weights of compactions
+        self.rng = random.Random(seed)
+        self._view = None           # sorted grades and cumulative weights
+
+    @property
+    def count(self):
+        """ Number of grades added (including NaN). """
+        return self.n + self.n_nan
+
+    def capacity(self, h):
+        """ Return capacity of level h. """
+        depth = len(self.levels) - h - 1
+        return max(MIN_CAPACITY, int(self.k * CAPACITY_RATIO**depth))
+
+    def update(self, x):
+        """ Add grade x to the sketch. """
+        if x != x:
+            self.n_nan += 1
+            return
+        self.levels[0].append(x)
+        self.n += 1
+        self._view = None
+        if len(self.levels[0]) >= self.capacity(0):
+            self._compress()
+
+    def extend(self, values):
+        """ Add the (non-MISSING) grades in values to the sketch. """
+        for d in values:
+            if not ismissing(d):
+                self.update(d)
+
+    def merge(self, other):
+        """
+        Add the grades summarized by sketch other to this sketch (as if
+        they had been added here).  Return this sketch.
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for h, grades in enumerate(other.levels):
+            self.levels[h].extend(grades)
+        self.n += other.n
+        self.n_nan += other.n_nan
+        self.max_error += other.max_error
+        self.sum_sq_error += other.sum_sq_error
+        self._view = None
+        self._compress()
+        return self
+
+    def _compress(self):
+        """ Compact full levels until every level is within capacity. """
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) >= self.capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append([])
+                self._compact(h)
+                h = 0       # capacities change when a level is added
+            else:
+                h += 1
+
+    def _compact(self, h):
+        """ Move every other grade of level h up to level h+1. """
+        grades = sorted(self.levels[h])
+        kept = []
+        if len(grades) % 2:
+            kept.append(grades.pop())
+        offset = self.rng.randrange(2)
+        self.levels[h+1].extend(grades[offset::2])
+        self.levels[h] = kept
+        weight = 2**h
+        self.max_error += weight
+        self.sum_sq_error += weight * weight
+
+    def _sorted_view(self):
+        """
+        Return sorted list of the grades in the sketch, and list giving
+        for each i the total weight of the first i of them.
+        """
+        if self._view is None:
+            weighted = sorted((x, 2**h) for h, grades in enumerate(self.levels)
+                              for x in grades)
+            grades = [x for x, w in weighted]
+            cumulative = [0]
+            for x, w in weighted:
+                cumulative.append(cumulative[-1] + w)
+            self._view = grades, cumulative
+        return self._view
+
+    def rank(self, x):
+        """
+        Return estimated numbers of (non-NaN) grades less than x, and
+        less than or equal to x.  (Exact if the sketch was never
+        compacted, that is, if max_error is 0.)
+        """
+        grades, cumulative = self._sorted_view()
+        return (cumulative[bisect.bisect_left(grades, x)],
+                cumulative[bisect.bisect_right(grades, x)])
+
+    def beats(self, x):
+        """
+        Return estimated beats count of a student with grade x (not
+        MISSING), as defined for rank.compute_beats.
+        """
+        if x != x:
+            # NaN is equal to and greater than nothing, so it only beats itself
+            return 1.0
+        below, at_most = self.rank(x)
+        return below + 0.5*(at_most - below - 1) + 1.0
+
+    def error_bound(self, confidence=0.99):
+        """
+        Return bound on the error of estimated counts of grades below
+        a given grade (as from rank), holding with given probability.
+        """
+        if self.sum_sq_error == 0:
+            return 0
+        hoeffding = math.sqrt(2.0 * self.sum_sq_error
+                              * math.log(2.0 / (1.0 - confidence)))
+        return min(self.max_error, hoeffding)
+
+def build_sketches(state, k=DEFAULT_K, seed=1):
+    """
+    Return dict mapping each weighted column of state (whose data has
+    been converted, as by rank.read_grades) to a sketch of its grades.
+    """
+    sketches = dict()
+    for col in state.columns:
+        if state.weights[col] > 0:
+            sketches[col] = QuantileSketch(k, seed)
+            sketches[col].extend(state.column(col))
+    return sketches
+
+def merge_sketches(sketches, more_sketches):
+    """
+    Merge dict more_sketches (as from build_sketches, e.g. for another
+    section of the class) into dict sketches, column by column.
+    Return sketches.
+    """
+    for col, more in more_sketches.items():
+        if col in sketches:
+            sketches[col].merge(more)
+        else:
+            sketches[col] = more
+    return sketches
+
+def print_error_report(names, sketches, confidence=0.99):
+    """
+    Print, for each sketched column, the bound on its rank error (as a
+    number of students, and as a fraction of the students).
+    """
+    if not sketches:
+        print("Approximate rank-based scores: no weighted columns to sketch")
+        return
+    print("Approximate rank-based scores (sketch size %d); "
+          "rank error bounds (%g%% confidence):"
+          % (max(s.k for s in sketches.values()), 100*confidence))
+    worst = 0.0
+    for col in sorted(sketches):
+        s = sketches[col]
+        bound = s.error_bound(confidence)
+        fraction = bound / (s.count + 1.0)
+        worst = max(worst, fraction)
+        print("    %-20s %10.1f students (%.4f%%), worst case %d"
+              % (names[col].strip(), bound, 100*fraction, s.max_error))
+    print("Largest rank error bound: %.4f%% of the students" % (100*worst))
@@ -0,0 +1,318 @@
+# stability.py
+# bootstrap rank-stability analysis for student ranking program (rank.py)
+# python3
+
+"""
+Estimate how stable each student's rank is, by re-ranking the class
+many times under random variations of the grades:
+
+    python3 stability.py grades.csv --resamples 10000 --top-k 10 --jobs 8
+
+Two models of variation are available (--mode):
+
+    components  the graded components are resampled with replacement
+                (a bootstrap over homeworks, quizzes, etc.); a component
+                drawn m times counts with m times its weight.  Each
+                component's scores don't depend on the others, so they
+                are computed (and dropped according to the drop policy)
+                just once.
+
+    noise       each grade is perturbed by Gaussian noise with standard
+                deviation NOISE times the component's perfect grade, and
+                the class is then re-scored, dropped and ranked just as
+                by rank.py.  Each column is re-sorted starting from the
+                sorted order of the unperturbed grades, which the
+                perturbed grades are nearly in, so sorting is fast.
+
+For each student the rank in the actual ranking (after dropping, as
+in the last table output by rank.py) is reported together with the
+mean rank over the resamples, a confidence interval for the rank,
+and the probability of being in the top k.  These are written to
+INPUT.stability.csv, in order of actual rank.
+
+Resamples are run in batches, each with its own random number
+generator seeded from the master seed and the batch number, so the
+results depend only on the seed, not on the number of jobs.
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import random
+import types
+
+import policy
+import rank
+
+BATCH_SIZE = 50          # resamples per batch
+
+class StabilityModel():
+    """
+    What is needed to run resamples for a class, computed once:
+        mode, noise     as above
+        names, perfect_grades, weights, and grade columns of the class
+        weighted        list of weighted columns
+        policy          policy followed (as for rank.rank_pipeline)
+        rank_weight     RANK_WEIGHT used for scoring
+        plan            compiled drop policy (a policy.DropPlan)
+        scores          (dropped) score columns, for mode "components"
+        orders          for each weighted column, its students with
+                        (non-NaN) grades, sorted by grade
+    """
+    def __init__(self, grade_state, mode="components", noise=0.05,
+                 policy=policy):
+        if mode not in ("components", "noise"):
+            raise ValueError("unknown resampling mode: " + str(mode))
+        self.mode = mode
+        self.noise = noise
+        self.names = list(grade_state.names)
+        self.perfect_grades = list(grade_state.perfect_grades)
+        self.weights = list(grade_state.weights)
+        self.n_stu = grade_state.n_stu
+        self.grades = [list(grade_state.column(col))
+                       for col in grade_state.columns]
+        self.weighted = [col for col in grade_state.columns
+                         if self.weights[col] > 0]
+        self.policy = policy
+        self.rank_weight = policy.RANK_WEIGHT
+        self.plan = policy.compile_drop_policy(self.names, policy.DROP_POLICY)
+
+        score_state = self.dropped(rank.compute_scores(grade_state, 1,
+                                                       self.rank_weight))
+        self.base_wtd_score = policy.compute_wtd_scores(score_state)
+        self.scores = None
+        self.orders = None
+        if mode == "components":
+            self.scores = [list(score_state.column(col))
+                           for col in grade_state.columns]
+        else:
+            self.orders = dict()
+            for col in self.weighted:
+                values = self.grades[col]
+                order = [stu for stu, d in enumerate(values)
+                         if not rank.ismissing(d) and d == d]
+                order.sort(key=values.__getitem__)
+                self.orders[col] = order
+
+    def __getstate__(self):
+        # a policy module can't be pickled (for worker processes that
+        # aren't forked), so it is sent by name and imported again
+        state = dict(self.__dict__)
+        if isinstance(self.policy, types.ModuleType):
+            state["policy"] = self.policy.__name__
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["policy"], str):
+            state["policy"] = importlib.import_module(state["policy"])
+        self.__dict__.update(state)
+
+    def dropped(self, score_state):
+        """ Return score_state with scores dropped by the drop policy. """
+        return self.policy.drop(score_state.copy(), self.policy.DROP_POLICY,
+                                False, plan=self.plan)
+
+    def resample(self, rng):
+        """
+        Return weighted scores of all students for one resample,
+        using random number generator rng.
+        """
+        if self.mode == "components":
+            return self.resample_components(rng)
+        return self.resample_noise(rng)
+
+    def resample_components(self, rng):
+        """
+        Return weighted scores for one bootstrap resample of columns: a
+        column drawn m times counts with m times its weight.
+        """
+        counts = dict()
+        for _ in self.weighted:
+            col = rng.choice(self.weighted)
+            counts[col] = counts.get(col, 0) + 1
+        weights = [counts.get(col, 0) * w for col, w in enumerate(self.weights)]
+        score_state = rank.CowState.from_columns(self.names,
+                                                 self.perfect_grades,
+                                                 weights, self.scores)
+        return self.policy.compute_wtd_scores(score_state)
+
+    def resample_noise(self, rng):
+        """
+        Return weighted scores after perturbing every grade with noise,
+        scoring as by rank.compute_scores.
+        """
+        rank_weight = self.rank_weight
+        columns = list(self.grades)
+        for col in self.weighted:
+            sigma = self.noise * self.perfect_grades[col]
+            values = list(self.grades[col])
+            for stu in self.orders[col]:
+                values[stu] += rng.gauss(0.0, sigma)
+            beats, n = rank.column_beats(values, self.orders[col])
+            # as in rank.normalize_scores
+            pg = self.perfect_grades[col]
+            columns[col] = [rank.MISSING if rank.ismissing(d)
+                            else rank_weight*(b / (float(n) + 1.0))
+                                 + (1-rank_weight)*(d / pg)
+                            for d, b in zip(values, beats)]
+        score_state = rank.CowState.from_columns(self.names,
+                                                 self.perfect_grades,
+                                                 self.weights, columns)
+        return self.policy.compute_wtd_scores(self.dropped(score_state))
+
+def run_batch(model, seed, batch, n_resamples):
+    """
+    Run n_resamples resamples with generator seeded by (seed, batch).
+    Return, for each student, a dict mapping rank to number of times
+    the student had that rank.
+    """
+    rng = random.Random("%d/%d" % (seed, batch))
+    rank_counts = [dict() for stu in range(model.n_stu)]
+    for _ in range(n_resamples):
+        for counts, r in zip(rank_counts,
+                             rank.ranks_of(model.resample(rng))):
+            counts[r] = counts.get(r, 0) + 1
+    return rank_counts
+
+_MODEL = None
+
+def _init_worker(model):
+    """ Initializer for worker processes: keep model for run_batch. """
+    global _MODEL
+    _MODEL = model
+
+def _batch_worker(args):
+    """ Worker running one batch of resamples on the worker's model. """
+    return run_batch(_MODEL, *args)
+
+class StabilityResult():
+    """
+    Result of bootstrap:
+        base_ranks      rank of each student in the actual ranking
+        rank_counts     for each student, dict mapping rank to number
+                        of resamples giving the student that rank
+        n_resamples     total number of resamples
+    """
+    def __init__(self, base_ranks, rank_counts, n_resamples):
+        self.base_ranks = base_ranks
+        self.rank_counts = rank_counts
+        self.n_resamples = n_resamples
+
+    def mean_rank(self, stu):
+        """ Return mean rank of student stu over the resamples. """
+        return sum(r * c for r, c in self.rank_counts[stu].items()) \
+            / float(self.n_resamples)
+
+    def interval(self, stu, confidence=0.95):
+        """
+        Return (lo, hi): the given central fraction of the resamples
+        rank student stu between lo and hi (inclusive).
+        """
+        tail = (1.0 - confidence) / 2.0 * self.n_resamples
+        lo = hi = None
+        seen = 0
+        for r in sorted(self.rank_counts[stu]):
+            seen += self.rank_counts[stu][r]
+            if lo is None and seen > tail:
+                lo = r
+            if seen >= self.n_resamples - tail:
+                hi = r
+                break
+        return lo, hi
+
+    def p_top(self, stu, k):
+        """ Return fraction of resamples ranking student stu in top k. """
+        return sum(c for r, c in self.rank_counts[stu].items() if r <= k) \
+            / float(self.n_resamples)
+
+def bootstrap(grade_state, n_resamples=1000, mode="components", noise=0.05,
+              jobs=1, seed=1, policy=policy):
+    """
+    Rank the students in grade_state (converted, as by rank.read_grades)
+    under n_resamples random variations (see above), following policy
+    (as for rank.rank_pipeline).  If jobs > 1, the resamples are run by
+    that many worker processes.  Return a StabilityResult.
+    """
+    model = StabilityModel(grade_state, mode, noise, policy)
+    batches = [(seed, batch, min(BATCH_SIZE, n_resamples - start))
+               for batch, start in enumerate(range(0, n_resamples,
+                                                   BATCH_SIZE))]
+    rank_counts = [dict() for stu in grade_state.students]
+    def merge(batch_counts):
+        for counts, more in zip(rank_counts, batch_counts):
+            for r, c in more.items():
+                counts[r] = counts.get(r, 0) + c
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_init_worker,
+                initargs=(model,)) as executor:
+            for batch_counts in executor.map(_batch_worker, batches):
+                merge(batch_counts)
+    else:
+        for args in batches:
+            merge(run_batch(model, *args))
+    return StabilityResult(rank.ranks_of(model.base_wtd_score),
+                           rank_counts, n_resamples)
+
+def write_stability(file_name, grade_state, result, top_k, confidence):
+    """
+    Write CSV file with one row per student (in order of actual rank),
+    giving the student's first column (e.g. ID), actual rank, mean rank,
+    rank confidence interval and probability of being in the top k.
+    """
+    ids = grade_state.column(0)
+    order = sorted(grade_state.students, key=lambda stu: result.base_ranks[stu])
+    with open(file_name, "w") as file:
+        file.write(", ".join([grade_state.names[0], "rank", "mean_rank",
+                              "rank_lo_%g" % (100*confidence),
+                              "rank_hi_%g" % (100*confidence),
+                              "p_top_%d" % top_k]))
+        file.write("\n")
+        for stu in order:
+            lo, hi = result.interval(stu, confidence)
+            file.write("%s, %d, %.2f, %d, %d, %.4f\n"
+                       % (str(ids[stu]).strip(), result.base_ranks[stu],
+                          result.mean_rank(stu), lo, hi,
+                          result.p_top(stu, top_k)))
+
+def main():
+    """ Main routine. """
+    parser = argparse.ArgumentParser(\
+                description='Estimate stability of student ranks.')
+    parser.add_argument('input_filename',
+                        help='csv file, in the format read by rank.py')
+    parser.add_argument('--skiprows', default=0,
+                        help='number of rows to skip before header row')
+    parser.add_argument('--resamples', default=1000,
+                        help='number of resamples')
+    parser.add_argument('--mode', default='components',
+                        choices=['components', 'noise'],
+                        help='resample components, or add noise to grades')
+    parser.add_argument('--noise', default=0.05,
+                        help='noise standard deviation, as a fraction '\
+                        'of the perfect grade (for --mode noise)')
+    parser.add_argument('--top-k', default=10,
+                        help='report probability of being in top k')
+    parser.add_argument('--confidence', default=0.95,
+                        help='confidence level of rank intervals')
+    parser.add_argument('--jobs', default=1,
+                        help='number of worker processes')
+    parser.add_argument('--seed', default=1,
+                        help='random number seed')
+    args = parser.parse_args()
+
+    print("Reading input file:", args.input_filename)
+    grade_state = rank.read_grades(args.input_filename, int(args.skiprows))
+    print(grade_state.n_stu, "students,", args.resamples, "resamples",
+          "(%s)" % args.mode)
+    result = bootstrap(grade_state, int(args.resamples), args.mode,
+                       float(args.noise), int(args.jobs), int(args.seed))
+
+    top_k = int(args.top_k)
+    confidence = float(args.confidence)
+    output_filename = args.input_filename + ".stability.csv"
+    write_stability(output_filename, grade_state, result, top_k, confidence)
+    print(output_filename, "written.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# sweep.py
+# scenario sweep for student ranking program (rank.py)
+# python3
+
+"""
+Compare many grading scenarios -- combinations of RANK_WEIGHT and
+DROP_POLICY -- in one run:
+
+    python3 sweep.py grades.csv --rank-weights 0,0.25,0.5,0.75,1 \
+                                --drop-policies drops.json
+
+The CSV file is read and the components are scored only once: the
+rank-based and grade-based score of every student on every component
+are computed once (with rank.normalize_scores, with RANK_WEIGHT 1 and
+0).  Each scenario's scores are then just the linear combination
+    RANK_WEIGHT*rank_based + (1-RANK_WEIGHT)*grade_based
+(exactly as computed by rank.normalize_scores), followed by the drop
+policy, weighted scores and ranking.
+
+drops.json, if given, maps a label for each drop policy to a list of
+drop policy items in the form used in policy.py, e.g.
+    {"none": [], "drop1": [[1, "H1", "H2", "H3", "H4"]]}
+Otherwise the single DROP_POLICY of policy.py is used.
+
+The ranks of each student under each scenario are written to
+INPUT.sweep.csv, and for each scenario a summary of the rank changes
+relative to the first scenario is printed.
+"""
+
+import argparse
+import json
+
+import policy
+import rank
+
+class Scenario():
+    """ One (RANK_WEIGHT, DROP_POLICY) combination to be evaluated. """
+    def __init__(self, rank_weight, drop_label, drop_policy):
+        self.rank_weight = rank_weight
+        self.drop_label = drop_label
+        self.drop_policy = drop_policy
+
+    def label(self):
+        """ Return short label for scenario. """
+        return "rw=%g/%s" % (self.rank_weight, self.drop_label)
+
+def component_scores(grade_state):
+    """
+    Return the rank-based and grade-based score states for grade_state,
+    i.e. the scores for RANK_WEIGHT 1 and RANK_WEIGHT 0.
+    """
+    beats, stu_per_comp = rank.compute_beats(grade_state)
+    rank_based = rank.normalize_scores(grade_state, beats, stu_per_comp, 1.0)
+    grade_based = rank.normalize_scores(grade_state, beats, stu_per_comp, 0.0)
+    return rank_based, grade_based
+
+def combine_scores(rank_based, grade_based, rank_weight):
+    """
+    Return score state for given rank_weight, combining the rank-based
+    and grade-based score states; the same as rank.compute_scores with
+    that rank_weight.
+    """
+    score_state = rank_based.copy()
+    for col in rank_based.columns:
+        if rank_based.weights[col] > 0:
+            score_state.set_column(col, [
+                rank.MISSING if rank.ismissing(r)
+                else rank_weight*r + (1-rank_weight)*g
+                for r, g in zip(rank_based.column(col),
+                                grade_based.column(col))])
+    return score_state
+
+def sweep(grade_state, scenarios):
+    """
+    Return list giving, for each scenario, the rank of each student
+    in grade_state (after dropping, if the drop policy has any items).
+    """
+    rank_based, grade_based = component_scores(grade_state)
+    plans = dict()
+    all_ranks = []
+    for scenario in scenarios:
+        score_state = combine_scores(rank_based, grade_based,
+                                     scenario.rank_weight)
+        if scenario.drop_policy != []:
+            if scenario.drop_label not in plans:
+                plans[scenario.drop_label] = policy.compile_drop_policy(
+                    grade_state.names, scenario.drop_policy)
+            score_state = policy.drop(score_state, scenario.drop_policy,
+                                      False, plans[scenario.drop_label])
+        wtd_score = policy.compute_wtd_scores(score_state)
+        all_ranks.append(rank.ranks_of(wtd_score))
+    return all_ranks
+
+def rank_changes(base_ranks, ranks):
+    """
+    Return (number of students whose rank changed, mean absolute rank
+    change, maximum absolute rank change) between two rankings.
+    """
+    changes = [abs(r - r0) for r0, r in zip(base_ranks, ranks)]
+    if not changes:
+        return 0, 0.0, 0
+    return (sum(1 for c in changes if c > 0),
+            sum(changes) / float(len(changes)),
+            max(changes))
+
+def write_sweep(file_name, grade_state, scenarios, all_ranks):
+    """
+    Write CSV file with one row per student (in order of rank in the
+    first scenario), giving the student's first column (e.g. ID) and
+    rank in each scenario.
+    """
+    ids = grade_state.column(0)
+    order = sorted(grade_state.students, key=lambda stu: all_ranks[0][stu])
+    with open(file_name, "w") as file:
+        file.write(", ".join([grade_state.names[0]] +
+                             [scenario.label() for scenario in scenarios]))
+        file.write("\n")
+        for stu in order:
+            file.write(", ".join([str(ids[stu]).strip()] +
+                                 [str(ranks[stu]) for ranks in all_ranks]))
+            file.write("\n")
+
+def main():
+    """ Main routine. """
+    parser = argparse.ArgumentParser(\
+                description='Rank students under many scenarios at once.')
+    parser.add_argument('input_filename',
+                        help='csv file, in the format read by rank.py')
+    parser.add_argument('--skiprows', default=0,
+                        help='number of rows to skip before header row')
+    parser.add_argument('--rank-weights', default=str(policy.RANK_WEIGHT),
+                        help='comma-separated list of RANK_WEIGHT values')
+    parser.add_argument('--drop-policies',
+                        help='JSON file mapping labels to drop policies '\
+                        '(default: DROP_POLICY of policy.py)')
+    args = parser.parse_args()
+
+    rank_weights = [float(rw) for rw in args.rank_weights.split(",")]
+    if args.drop_policies:
+        with open(args.drop_policies) as file:
+            drop_policies = [(label, [tuple(item) for item in items])
+                             for label, items in json.load(file).items()]
+    else:
+        drop_policies = [("policy.py", policy.DROP_POLICY)]
+    scenarios = [Scenario(rw, label, drop_policy)
+                 for label, drop_policy in drop_policies
+                 for rw in rank_weights]
+
+    print("Reading input file:", args.input_filename)
+    grade_state = rank.read_grades(args.input_filename, int(args.skiprows))
+    print(grade_state.n_stu, "students,", len(scenarios), "scenarios")
+    all_ranks = sweep(grade_state, scenarios)
+
+    print("Rank changes relative to first scenario (%s):"
+          % scenarios[0].label())
+    print("  %-30s %8s %10s %8s" % ("scenario", "changed", "mean |d|", "max |d|"))
+    for scenario, ranks in zip(scenarios, all_ranks):
+        changed, mean_change, max_change = rank_changes(all_ranks[0], ranks)
+        print("  %-30s %8d %10.2f %8d"
+              % (scenario.label(), changed, mean_change, max_change))
+
+    output_filename = args.input_filename + ".sweep.csv"
+    write_sweep(output_filename, grade_state, scenarios, all_ranks)
+    print(output_filename, "written.")
+
+if __name__ == "__main__":
+    main()